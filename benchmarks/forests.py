@@ -0,0 +1,54 @@
+"""
+Generators of synthetic comment forests. Forest is a list of parents, where
+parents[i] is index of parent of comment i (always less than i) or None for root.
+
+"""
+import random
+
+
+def wide(size, seed=None):
+    """
+    Flat forest: every comment is a root thread.
+
+    """
+    return [None] * size
+
+
+def deep(size, seed=None, chain_length=100):
+    """
+    Chains of ``chain_length`` replies, every reply answers the previous comment.
+
+    """
+    return [None if i % chain_length == 0 else i - 1 for i in range(size)]
+
+
+def power_law(size, seed=None, root_probability=0.05):
+    """
+    Realistic forest: a comment starts new thread with ``root_probability``, otherwise
+    it replies to an existing comment chosen with probability proportional to number of
+    its replies plus one (preferential attachment), so reply counts follow power law.
+
+    """
+    generator = random.Random(seed)
+    parents = []
+    # every comment is added once and once more for every reply to it...
+    candidates = []
+
+    for i in range(size):
+        if not candidates or generator.random() < root_probability:
+            parents.append(None)
+        else:
+            parent = generator.choice(candidates)
+            parents.append(parent)
+            candidates.append(parent)
+
+        candidates.append(i)
+
+    return parents
+
+
+FORESTS = {
+    'wide': wide,
+    'deep': deep,
+    'power_law': power_law,
+}
@@ -0,0 +1,331 @@
+"""
+Benchmarks of read and write paths of comments on synthetic forests (see forests.py).
+Every operation is repeated, its time and number of queries are saved as JSON,
+so results of two runs can be compared with --compare.
+
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import random
+import timeit
+from datetime import timedelta
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import django
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.template import Context, Template
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from comments.models import Comment
+from comments.tree import COMMENTS_TREE_BACKEND
+from comments.utils import annotate_comment_tree, CommentTree
+
+from benchmarks.forests import FORESTS
+from tests.models import TestCommentedObject
+
+
+BENCHMARK_USER = {'username': 'benchmark', 'email': 'benchmark@benchmark.benchmark', 'password': 'benchmark'}
+
+RENDER_TEMPLATE = '{% load comment_tags %}{% render_comment_list for object %}'
+
+
+class Measurement(object):
+    def __init__(self):
+        self.times = []
+        self.queries = []
+        self.peak_memory = None
+
+    def as_dict(self):
+        times = sorted(self.times)
+
+        return {
+            'time': {
+                'min': times[0],
+                'median': times[len(times) // 2],
+                'max': times[-1],
+            },
+            'queries': max(self.queries),
+            'peak_memory': self.peak_memory,
+        }
+
+
+def measure(operation, repeat, trace_memory=False):
+    """
+    Call ``operation`` ``repeat`` times and measure time and number of queries of every call,
+    peak memory of one more call is traced if ``trace_memory`` is True.
+
+    """
+    measurement = Measurement()
+
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            start = timeit.default_timer()
+            operation()
+            measurement.times.append(timeit.default_timer() - start)
+
+        measurement.queries.append(len(queries))
+
+    if trace_memory and tracemalloc is not None:
+        tracemalloc.start()
+        operation()
+        measurement.peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return measurement
+
+
+def create_forest(parents, user):
+    commented_object = TestCommentedObject.objects.create()
+    content_type = ContentType.objects.get_for_model(commented_object)
+
+    items = (
+        (i, parent, Comment(
+            user=user,
+            content_type=content_type,
+            object_id=commented_object.pk,
+            comment='Benchmark comment {0}'.format(i)
+        ))
+        for i, parent in enumerate(parents)
+    )
+
+    known = Comment.objects.bulk_create_tree(items, batch_size=5000)
+
+    return commented_object, [known[i][0] for i in range(len(parents))]
+
+
+def benchmark_forest(name, size, user, client, repeat, seed):
+    parents = FORESTS[name](size, seed=seed)
+    commented_object, ids = create_forest(parents, user)
+    root_ids = [ids[i] for i, parent in enumerate(parents) if parent is None]
+    generator = random.Random(seed)
+
+    template = Template(RENDER_TEMPLATE)
+    context = {'object': commented_object, 'user': user}
+    queryset = Comment.objects.filter(
+        content_type=ContentType.objects.get_for_model(commented_object),
+        object_id=commented_object.pk
+    ).for_tree()
+    comments = list(queryset)
+
+    def render_comment_list():
+        template.render(Context(context))
+
+    def annotate():
+        for comment in annotate_comment_tree(list(comments)):
+            pass
+
+    def comment_tree():
+        for node in CommentTree((comment.id, comment.path) for comment in comments).annotate():
+            pass
+
+    subtree_roots = Comment.objects.filter(pk__in=ids).only('id', 'path', 'content_type', 'object_id')
+    subtree_roots = list(subtree_roots[:repeat])
+
+    def subtree():
+        list(Comment.objects.descendants(generator.choice(subtree_roots)).values_list('id', flat=True))
+
+    def add_comment():
+        client.post(
+            reverse('add_comment'),
+            {'comment': 'Benchmark reply', 'object_id': commented_object.pk, 'parent': generator.choice(ids)},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+
+    def remove_comment():
+        client.post(
+            reverse('remove_comment'),
+            {'comment_id': generator.choice(ids)},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+
+    removable_roots = list(root_ids)
+    generator.shuffle(removable_roots)
+
+    def remove_comment_tree():
+        client.post(
+            reverse('remove_comment_tree'),
+            {'parent_id': removable_roots.pop() if removable_roots else root_ids[0]},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+
+    # read operations go first, write operations change the forest...
+    operations = [
+        ('render_comment_list', render_comment_list, True),
+        ('annotate_comment_tree', annotate, True),
+        ('comment_tree', comment_tree, True),
+        ('subtree', subtree, False),
+        ('add_comment', add_comment, False),
+        ('remove_comment', remove_comment, False),
+        ('remove_comment_tree', remove_comment_tree, False),
+    ]
+
+    results = []
+
+    for operation_name, operation, trace_memory in operations:
+        result = measure(operation, repeat, trace_memory).as_dict()
+        result.update({'forest': name, 'size': size, 'operation': operation_name})
+        results.append(result)
+
+        print_result(result)
+
+    return results
+
+
+def benchmark_archive(size, user, repeat, seed, cold_objects=10):
+    """
+    Render comments of one hot object while ``cold_objects`` objects with old comments
+    are in the comments table and after they are archived.
+
+    """
+    parents = FORESTS['power_law'](size, seed=seed)
+    hot_object, ids = create_forest(parents, user)
+
+    for _ in range(cold_objects):
+        cold_object, cold_ids = create_forest(parents, user)
+        Comment.objects.filter(pk__in=cold_ids).update(pub_date=timezone.now() - timedelta(days=365))
+
+    template = Template(RENDER_TEMPLATE)
+    context = {'object': hot_object, 'user': user}
+
+    def render_comment_list():
+        template.render(Context(context))
+
+    def archive():
+        Comment.objects.archive_threads(before=timezone.now() - timedelta(days=30), batch_size=1000)
+
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE {0}'.format(connection.ops.quote_name(Comment._meta.db_table)))
+
+    operations = [
+        ('render_before_archive', render_comment_list, repeat),
+        ('archive_threads', archive, 1),
+        ('render_after_archive', render_comment_list, repeat),
+    ]
+
+    results = []
+
+    for operation_name, operation, operation_repeat in operations:
+        result = measure(operation, operation_repeat).as_dict()
+        result.update({'forest': 'archive', 'size': size, 'operation': operation_name})
+        results.append(result)
+
+        print_result(result)
+
+    return results
+
+
+def print_result(result):
+    print('{forest:>10} {size:>8} {operation:<22} {median:>10.4f}s {queries:>6} queries'.format(
+        median=result['time']['median'],
+        **result
+    ))
+
+
+def run(forests, sizes, repeat, seed, archive=False):
+    user_model = get_user_model()
+
+    try:
+        user = user_model.objects.get(username=BENCHMARK_USER['username'])
+    except user_model.DoesNotExist:
+        user = user_model.objects.create_superuser(
+            BENCHMARK_USER['username'],
+            BENCHMARK_USER['email'],
+            BENCHMARK_USER['password']
+        )
+
+    client = Client()
+    client.force_login(user)
+
+    results = []
+
+    for size in sizes:
+        for name in forests:
+            results.extend(benchmark_forest(name, size, user, client, repeat, seed))
+
+        if archive:
+            results.extend(benchmark_archive(size, user, repeat, seed))
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'tree_backend': COMMENTS_TREE_BACKEND,
+            'repeat': repeat,
+            'seed': seed,
+        },
+        'results': results,
+    }
+
+
+def compare(old_path, new_path):
+    """
+    Print median time and queries of operations of two runs and ratio new / old.
+
+    """
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old = {(r['forest'], r['size'], r['operation']): r for r in json.load(old_file)['results']}
+        new = {(r['forest'], r['size'], r['operation']): r for r in json.load(new_file)['results']}
+
+    for key in sorted(set(old) & set(new)):
+        old_time = old[key]['time']['median']
+        new_time = new[key]['time']['median']
+
+        print('{0:>10} {1:>8} {2:<22} {3:>10.4f}s {4:>10.4f}s {5:>7.2f}x {6:>6} -> {7} queries'.format(
+            key[0],
+            key[1],
+            key[2],
+            old_time,
+            new_time,
+            new_time / old_time if old_time else float('inf'),
+            old[key]['queries'],
+            new[key]['queries']
+        ))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks of comments (PostgreSQL database is required).')
+    parser.add_argument('--forests', default=','.join(sorted(FORESTS)), help='Comma separated forest names.')
+    parser.add_argument('--sizes', default='1000,10000', help='Comma separated numbers of comments in forest.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Save results as JSON to the file.')
+    parser.add_argument('--archive', action='store_true', help='Measure rendering before and after archival.')
+    parser.add_argument('--keepdb', action='store_true', help='Keep test database between runs.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare results of two runs.')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=args.keepdb)
+
+    try:
+        results = run(
+            args.forests.split(','),
+            [int(size) for size in args.sizes.split(',')],
+            args.repeat,
+            args.seed,
+            args.archive
+        )
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=args.keepdb)
+        teardown_test_environment()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=4)
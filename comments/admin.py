@@ -1,16 +1,159 @@
+import calendar
+import json
+from datetime import date, datetime
+
+from django.conf import settings
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.forms.models import BaseInlineFormSet
+from django.utils import six, timezone
+from django.utils.formats import date_format
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
 from comments.models import Comment
 
 
+# changelists with more rows (estimated by planner) show estimated count instead of COUNT(*)...
+
+COMMENTS_ADMIN_ESTIMATE_COUNT_THRESHOLD = getattr(settings, 'COMMENTS_ADMIN_ESTIMATE_COUNT_THRESHOLD', 10000)
+
+# maximum number of replies shown on change page of comment...
+
+COMMENTS_ADMIN_INLINE_LIMIT = getattr(settings, 'COMMENTS_ADMIN_INLINE_LIMIT', 50)
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator which takes count of large querysets from estimate of PostgreSQL planner
+    (EXPLAIN), so pages of changelist do not need COUNT(*) over the whole table.
+
+    """
+
+    @cached_property
+    def count(self):
+        try:
+            sql, params = self.object_list.query.sql_with_params()
+        except AttributeError:
+            return super(EstimatedCountPaginator, self).count
+
+        with connections[self.object_list.db].cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+
+        if isinstance(plan, six.string_types):
+            plan = json.loads(plan)
+
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+
+        if estimate < COMMENTS_ADMIN_ESTIMATE_COUNT_THRESHOLD:
+            return self.object_list.count()
+
+        return estimate
+
+
+class PubDateDrilldownFilter(admin.SimpleListFilter):
+    """
+    Year, month and day drilldown of "pub_date" (like date_hierarchy), every level is a range
+    on "pub_date" index and years are taken from the first and the last comment instead of
+    DISTINCT dates of all comments.
+
+    """
+
+    title = _('Date')
+    parameter_name = 'pub_date_drilldown'
+
+    def parse(self, value):
+        try:
+            parts = [int(part) for part in (value or '').split('-')]
+            date(*(parts + [1, 1])[:3])
+        except (TypeError, ValueError):
+            return []
+
+        return parts[:3]
+
+    def label(self, parts):
+        if len(parts) == 1:
+            return str(parts[0])
+
+        if len(parts) == 2:
+            return date_format(date(parts[0], parts[1], 1), 'YEAR_MONTH_FORMAT')
+
+        return date_format(date(*parts), 'MONTH_DAY_FORMAT')
+
+    def lookups(self, request, model_admin):
+        parts = self.parse(self.value())
+
+        if not parts:
+            pub_dates = model_admin.get_queryset(request).order_by('pub_date').values_list('pub_date', flat=True)
+            first, last = pub_dates.first(), pub_dates.last()
+
+            if first is None:
+                return []
+
+            if settings.USE_TZ:
+                first, last = timezone.localtime(first), timezone.localtime(last)
+
+            children = [[year] for year in range(first.year, last.year + 1)]
+        elif len(parts) == 1:
+            children = [parts + [month] for month in range(1, 13)]
+        elif len(parts) == 2:
+            children = [parts + [day] for day in range(1, calendar.monthrange(*parts)[1] + 1)]
+        else:
+            children = []
+
+        # selected level and its parents, then the next level...
+        levels = [parts[:length] for length in range(1, len(parts) + 1)] + children
+
+        return [('-'.join(str(part) for part in level), self.label(level)) for level in levels]
+
+    def queryset(self, request, queryset):
+        parts = self.parse(self.value())
+
+        if not parts:
+            return queryset
+
+        year, month, day = (parts + [None, None])[:3]
+        start = datetime(year, month or 1, day or 1)
+
+        if day is not None:
+            end = datetime.fromordinal(start.toordinal() + 1)
+        elif month is not None:
+            end = datetime(year + month // 12, month % 12 + 1, 1)
+        else:
+            end = datetime(year + 1, 1, 1)
+
+        if settings.USE_TZ:
+            start, end = timezone.make_aware(start), timezone.make_aware(end)
+
+        return queryset.filter(pub_date__gte=start, pub_date__lt=end)
+
+
 def remove_comments(modeladmin, request, queryset):
-    queryset.update(is_removed=True)
+    Comment.objects.mark_removed(queryset)
 remove_comments.short_description = _('To mark selected comments as removed')
 
 
+class LimitedInlineFormSet(BaseInlineFormSet):
+    """
+    Formset of the first COMMENTS_ADMIN_INLINE_LIMIT replies.
+
+    """
+
+    def get_queryset(self):
+        if not hasattr(self, '_queryset'):
+            queryset = super(LimitedInlineFormSet, self).get_queryset()
+            self._queryset = queryset.select_related('user')[:COMMENTS_ADMIN_INLINE_LIMIT]
+
+        return self._queryset
+
+
 class CommentTabularInline(admin.TabularInline):
     model = Comment
+    formset = LimitedInlineFormSet
+    raw_id_fields = ('user',)
     extra = 0
 
 
@@ -26,11 +169,34 @@ class CommentAdmin(admin.ModelAdmin):
     ]
 
     list_display = ('id', 'user', 'content_type', 'object_id', 'parent', 'is_removed', 'pub_date')
-    list_filter = ('pub_date', 'is_removed')
+    list_select_related = ('user', 'content_type', 'parent__user')
+    # drilldown by ranges of "pub_date" index instead of distinct dates of date_hierarchy...
+    list_filter = (PubDateDrilldownFilter, 'is_removed')
+    # searched by get_search_results...
     search_fields = ('comment', 'user__username', 'object_id')
-    date_hierarchy = 'pub_date'
     ordering = ['-pub_date']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     raw_id_fields = ('user', 'parent')
     actions = [remove_comments]
 
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Search comments by id or object id (number), author ("@username") or full text
+        of comment, so index is used instead of ILIKE over all comments.
+
+        """
+        search_term = search_term.strip()
+
+        if not search_term:
+            return queryset, False
+
+        if search_term.isdigit():
+            return queryset.filter(Q(pk=search_term) | Q(object_id=search_term)), False
+
+        if search_term.startswith('@'):
+            return queryset.filter(user__username=search_term[1:]), False
+
+        return queryset.search(search_term), False
+
 admin.site.register(Comment, CommentAdmin)
@@ -0,0 +1,222 @@
+import json
+import select
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+
+
+# broker of live comment events ("comment_events" view)...
+
+COMMENTS_BROKER = getattr(settings, 'COMMENTS_BROKER', 'comments.broker.InProcessBroker')
+
+# subscribe rendered comment list to "comment_events" view...
+
+COMMENTS_LIVE_EVENTS = getattr(settings, 'COMMENTS_LIVE_EVENTS', False)
+
+# number of recent events of object kept by InProcessBroker for reconnected clients...
+
+COMMENTS_EVENTS_BUFFER_SIZE = getattr(settings, 'COMMENTS_EVENTS_BUFFER_SIZE', 100)
+
+# seconds between heartbeats of idle event stream...
+
+COMMENTS_EVENTS_HEARTBEAT = getattr(settings, 'COMMENTS_EVENTS_HEARTBEAT', 15)
+
+# seconds after which event stream is closed (client reconnects with Last-Event-ID),
+# so disconnected clients do not hold workers forever...
+
+COMMENTS_EVENTS_MAX_DURATION = getattr(settings, 'COMMENTS_EVENTS_MAX_DURATION', 5 * 60)
+
+# seconds after which channel without subscribers and events is dropped by InProcessBroker...
+
+COMMENTS_EVENTS_CHANNEL_TTL = getattr(settings, 'COMMENTS_EVENTS_CHANNEL_TTL', 5 * 60)
+
+# sequence of ids of events published by PostgresBroker (see migration 0008)...
+
+EVENT_ID_SEQUENCE = 'comments_event_id_seq'
+
+
+def channel_name(content_type_id, object_id):
+    return 'comments_{0}_{1}'.format(content_type_id, object_id)
+
+
+class BaseBroker(object):
+    def publish(self, channel, event, data):
+        raise NotImplementedError
+
+    def subscribe(self, channel, last_event_id=None, timeout=None):
+        """
+        Yield (event_id, event, data) published to channel after subscription (or after
+        ``last_event_id`` if broker keeps recent events), None is yielded every ``timeout``
+        seconds without events.
+
+        """
+        raise NotImplementedError
+
+
+class InProcessChannel(object):
+    __slots__ = ('events', 'subscribers', 'used_at')
+
+    def __init__(self, buffer_size):
+        self.events = deque(maxlen=buffer_size)
+        self.subscribers = 0
+        self.used_at = time.time()
+
+
+class InProcessBroker(BaseBroker):
+    """
+    Broker for single process setups and tests. Event ids are increasing numbers of process,
+    recent events of channel are kept until channel has no subscribers and no events
+    for ``channel_ttl`` seconds.
+
+    """
+
+    def __init__(self, buffer_size=COMMENTS_EVENTS_BUFFER_SIZE, channel_ttl=COMMENTS_EVENTS_CHANNEL_TTL):
+        self.condition = threading.Condition()
+        self.buffer_size = buffer_size
+        self.channel_ttl = channel_ttl
+        self.channels = {}
+        self.last_event_id = 0
+        self.swept_at = time.time()
+
+    def publish(self, channel, event, data):
+        with self.condition:
+            self._drop_idle_channels()
+            self.last_event_id += 1
+            self._get_channel(channel).events.append((self.last_event_id, event, data))
+            self.condition.notify_all()
+
+    def subscribe(self, channel, last_event_id=None, timeout=None):
+        with self.condition:
+            if last_event_id is None or last_event_id > self.last_event_id:
+                # ids given by other (restarted) process are not comparable...
+                last_event_id = self.last_event_id
+
+            self._get_channel(channel).subscribers += 1
+
+        try:
+            while True:
+                with self.condition:
+                    events = self._events_after(channel, last_event_id)
+
+                    if not events:
+                        self.condition.wait(timeout)
+                        events = self._events_after(channel, last_event_id)
+
+                if not events:
+                    yield None
+
+                for event in events:
+                    last_event_id = event[0]
+                    yield event
+        finally:
+            with self.condition:
+                self._get_channel(channel).subscribers -= 1
+
+    def _get_channel(self, channel):
+        state = self.channels.get(channel)
+
+        if state is None:
+            state = self.channels[channel] = InProcessChannel(self.buffer_size)
+
+        state.used_at = time.time()
+
+        return state
+
+    def _drop_idle_channels(self):
+        now = time.time()
+
+        if now - self.swept_at < self.channel_ttl:
+            return
+
+        self.swept_at = now
+
+        for channel, state in list(self.channels.items()):
+            if not state.subscribers and now - state.used_at >= self.channel_ttl:
+                del self.channels[channel]
+
+    def _events_after(self, channel, last_event_id):
+        if channel not in self.channels:
+            return []
+
+        return [event for event in self.channels[channel].events if event[0] > last_event_id]
+
+
+class PostgresBroker(BaseBroker):
+    """
+    Broker for multi process setups based on LISTEN/NOTIFY of PostgreSQL. Notification
+    payload is limited by PostgreSQL, so too long rendered comments are not sent
+    (data has "truncated" key then). Recent events are not kept.
+    Event ids are taken from EVENT_ID_SEQUENCE under lock of channel held until commit,
+    so ids of channel increase in order of notifications.
+
+    """
+
+    max_payload_size = 7900
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    def publish(self, channel, event, data):
+        with transaction.atomic(using=self.using):
+            with connections[self.using].cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', [channel])
+                cursor.execute('SELECT nextval(%s)', [EVENT_ID_SEQUENCE])
+                event_id = cursor.fetchone()[0]
+
+                payload = json.dumps({'id': event_id, 'event': event, 'data': data})
+
+                if len(payload.encode('utf-8')) > self.max_payload_size:
+                    data = {key: value for key, value in data.items() if key not in ('comment', 'replace_data')}
+                    data['truncated'] = True
+                    payload = json.dumps({'id': event_id, 'event': event, 'data': data})
+
+                cursor.execute('SELECT pg_notify(%s, %s)', [channel, payload])
+
+    def subscribe(self, channel, last_event_id=None, timeout=None):
+        # LISTEN blocks connection, so every subscriber has own connection...
+        wrapper = connections[self.using]
+        connection = wrapper.get_new_connection(wrapper.get_connection_params())
+        connection.autocommit = True
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('LISTEN {0}'.format(wrapper.ops.quote_name(channel)))
+
+            while True:
+                if select.select([connection], [], [], timeout) == ([], [], []):
+                    yield None
+                    continue
+
+                connection.poll()
+
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    payload = json.loads(notify.payload)
+                    yield payload['id'], payload['event'], payload['data']
+        finally:
+            connection.close()
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+
+    if _broker is None:
+        _broker = import_string(COMMENTS_BROKER)()
+
+    return _broker
+
+
+def publish_comment_event(content_type_id, object_id, event, data, using=None):
+    """
+    Publish event of comments of object after commit of current transaction.
+
+    """
+    channel = channel_name(content_type_id, object_id)
+    transaction.on_commit(lambda: get_broker().publish(channel, event, data), using=using)
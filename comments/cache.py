@@ -0,0 +1,241 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils.translation import get_language
+
+
+# alias of cache for rendered comment trees (None - rendered trees are not cached)...
+
+COMMENTS_CACHE = getattr(settings, 'COMMENTS_CACHE', None)
+COMMENTS_CACHE_TIMEOUT = getattr(settings, 'COMMENTS_CACHE_TIMEOUT', 60 * 60)
+
+# number of comment trees (fetched and annotated comment lists) kept in memory of every process
+# (None - trees are not kept) and seconds they are kept...
+
+COMMENTS_TREE_LRU_SIZE = getattr(settings, 'COMMENTS_TREE_LRU_SIZE', None)
+COMMENTS_TREE_LRU_TIMEOUT = getattr(settings, 'COMMENTS_TREE_LRU_TIMEOUT', 60)
+
+# alias of cache for versions of comments of objects (None - COMMENTS_CACHE), it must be set
+# if COMMENTS_TREE_LRU_SIZE is set and shared by all processes, so trees kept in memory
+# of processes are invalidated by changes made by other processes...
+
+COMMENTS_VERSION_CACHE = getattr(settings, 'COMMENTS_VERSION_CACHE', None)
+
+# permissions which change rendered comment tree...
+
+COMMENTS_CACHE_PERMISSIONS = ('comments.remove_comment', 'comments.remove_comment_tree')
+
+
+def _version_key(content_type_id, object_id):
+    return 'comments:version:{0}:{1}'.format(content_type_id, object_id)
+
+
+def _new_version():
+    # version is based on time, so if version key is evicted from cache,
+    # new version will be greater than any previous version of object...
+    return int(time.time() * 1000)
+
+
+def _version_cache():
+    return caches[COMMENTS_VERSION_CACHE or COMMENTS_CACHE]
+
+
+def get_comments_version(content_type_id, object_id):
+    cache = _version_cache()
+    key = _version_key(content_type_id, object_id)
+    version = cache.get(key)
+
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key)
+
+    return version
+
+
+def bump_comments_version(content_type_id, object_id, using=None):
+    """
+    Invalidate cached comments of object. Version is bumped immediately and once more
+    after commit, so a tree rendered by concurrent request before commit is never used.
+
+    """
+    if COMMENTS_CACHE is None and tree_lru is None:
+        return None
+
+    def bump():
+        cache = _version_cache()
+        key = _version_key(content_type_id, object_id)
+
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, _new_version(), None)
+
+    bump()
+    transaction.on_commit(bump, using=using)
+
+
+def tree_cache_key(content_type_id, object_id, user=None):
+    """
+    Return cache key of rendered comment tree of object for user (None if cache is disabled).
+
+    """
+    if COMMENTS_CACHE is None:
+        return None
+
+    permissions = ''.join(
+        '1' if user is not None and user.has_perm(permission) else '0'
+        for permission in COMMENTS_CACHE_PERMISSIONS
+    )
+
+    return 'comments:tree:{0}:{1}:{2}:{3}:{4}'.format(
+        content_type_id,
+        object_id,
+        get_comments_version(content_type_id, object_id),
+        permissions,
+        get_language()
+    )
+
+
+def get_fragment(key):
+    return caches[COMMENTS_CACHE].get(key)
+
+
+def set_fragment(key, rendered):
+    caches[COMMENTS_CACHE].set(key, rendered, COMMENTS_CACHE_TIMEOUT)
+
+
+class LRUTreeCache(object):
+    """
+    Comment trees of objects kept in memory of process, keyed by (content_type_id, object_id).
+    Tree is used while version of comments of object is not changed and for ``timeout``
+    seconds, the least recently used trees are evicted above ``size`` trees.
+    Trees are copied when they are kept and returned (see get_tree), versions must be
+    kept in cache shared by processes (see check_version_cache).
+
+    """
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._trees = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._trees.pop(key, None)
+
+            if entry is None or entry[0] != version or entry[1] < time.time():
+                self.misses += 1
+                return None
+
+            # move tree to the end (the most recently used)...
+            self._trees[key] = entry
+            self.hits += 1
+
+            return entry[2]
+
+    def set(self, key, version, tree):
+        with self._lock:
+            self._trees.pop(key, None)
+            self._trees[key] = (version, time.time() + self.timeout, tree)
+
+            while len(self._trees) > self.size:
+                self._trees.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._trees),
+        }
+
+
+def check_version_cache():
+    """
+    Raise ImproperlyConfigured if COMMENTS_VERSION_CACHE is not set or its cache is not shared
+    by processes, changes made by other processes would not invalidate trees kept in memory.
+
+    """
+    if COMMENTS_VERSION_CACHE is None:
+        raise ImproperlyConfigured('COMMENTS_VERSION_CACHE must be set if COMMENTS_TREE_LRU_SIZE is set.')
+
+    if isinstance(caches[COMMENTS_VERSION_CACHE], (LocMemCache, DummyCache)):
+        raise ImproperlyConfigured(
+            'COMMENTS_VERSION_CACHE "{0}" must be shared by processes (not local memory or dummy cache).'.format(
+                COMMENTS_VERSION_CACHE
+            )
+        )
+
+
+def _copy_tree(tree):
+    # rendering sets attributes of comments (see annotate_comment_tree), so every render
+    # gets its own copies and comments kept in memory are never changed...
+    tree = dict(tree)
+    tree['comment_list'] = [copy.copy(comment) for comment in tree['comment_list']]
+
+    return tree
+
+
+def _create_tree_lru():
+    if not COMMENTS_TREE_LRU_SIZE:
+        return None
+
+    check_version_cache()
+
+    return LRUTreeCache(COMMENTS_TREE_LRU_SIZE, COMMENTS_TREE_LRU_TIMEOUT)
+
+
+tree_lru = _create_tree_lru()
+
+
+def get_tree(content_type_id, object_id):
+    """
+    Return comment tree of object kept in memory of process (None if it is not kept
+    or cache is disabled) and current version of comments of object.
+
+    """
+    if tree_lru is None:
+        return None, None
+
+    version = get_comments_version(content_type_id, object_id)
+    tree = tree_lru.get((content_type_id, object_id), version)
+
+    return (_copy_tree(tree) if tree is not None else None), version
+
+
+def set_tree(content_type_id, object_id, tree, version):
+    """
+    Keep comment tree of object for ``version`` returned by get_tree before the tree was
+    read, so the tree read before concurrent write is not used for new version.
+
+    """
+    if tree_lru is not None:
+        tree_lru.set((content_type_id, object_id), version, _copy_tree(tree))
+
+
+def tree_cache_stats():
+    """
+    Return hits, misses, evictions and number of trees kept in memory of process (None if cache is disabled).
+
+    """
+    if tree_lru is None:
+        return None
+
+    return tree_lru.stats()
@@ -0,0 +1,60 @@
+from datetime import timedelta
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from comments.models import Comment
+
+
+class Command(BaseCommand):
+    help = (
+        'Move root threads without comments for the last --days days (or of given objects) '
+        'to archive table by batches. Interrupted run is resumed by --after.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Archive threads without comments for this number of days.')
+        parser.add_argument('--model', help='Archive threads of objects of model (app_label.model_name).')
+        parser.add_argument('--object-id', type=int, action='append', dest='object_ids', help='Object of --model.')
+        parser.add_argument('--batch-size', type=int, default=100, dest='batch_size', help='Root threads per batch.')
+        parser.add_argument('--after', type=int, default=0, help='Start after this root comment id.')
+
+    def handle(self, *args, **options):
+        before = None
+        content_type = None
+
+        if options['days'] is not None:
+            before = timezone.now() - timedelta(days=options['days'])
+
+        if options['model']:
+            try:
+                content_type = ContentType.objects.get_for_model(apps.get_model(options['model']))
+            except (LookupError, ValueError) as err:
+                raise CommandError(err)
+        elif options['object_ids']:
+            raise CommandError('--object-id requires --model.')
+
+        if before is None and content_type is None:
+            raise CommandError('--days or --model is required.')
+
+        after = options['after']
+        archived = 0
+
+        while True:
+            after, moved = Comment.objects.archive_batch(
+                before,
+                content_type,
+                options['object_ids'],
+                after,
+                options['batch_size']
+            )
+
+            if after is None:
+                break
+
+            archived += moved
+            self.stdout.write('Archived {0} comments, last root id {1}.'.format(archived, after))
+
+        self.stdout.write('Archived {0} comments.'.format(archived))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from comments.tree import LtreeTreeBackend
+
+
+class Command(BaseCommand):
+    help = (
+        'Create (install) or drop (uninstall) "tree_path" ltree column of comments used by '
+        'LtreeTreeBackend, so COMMENTS_TREE_BACKEND can be switched without migrations. '
+        'Existing comments are filled by batches.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('install', 'uninstall'))
+        parser.add_argument('--batch-size', type=int, default=10000, dest='batch_size', help='Comments per batch.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, help='Database alias.')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        backend = LtreeTreeBackend()
+
+        if options['action'] == 'uninstall':
+            backend.uninstall(connection)
+            self.stdout.write('Column "tree_path" is dropped.')
+            return
+
+        if backend.is_installed(connection):
+            raise CommandError('Column "tree_path" already exists.')
+
+        filled = backend.install(connection, options['batch_size'])
+        self.stdout.write('Column "tree_path" is created, {0} comments are filled.'.format(filled))
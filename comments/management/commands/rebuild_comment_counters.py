@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from comments.models import CommentCounter
+
+
+class Command(BaseCommand):
+    help = 'Rebuild counters of comments of all objects from scratch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, dest='batch_size')
+
+    def handle(self, *args, **options):
+        rebuilt = CommentCounter.objects.rebuild_all(batch_size=options['batch_size'])
+        self.stdout.write('Rebuilt {0} comment counters.'.format(rebuilt))
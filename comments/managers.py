@@ -1,27 +1,780 @@
-from django.db import models
+from collections import defaultdict
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections, models, router, transaction
+from django.db.models import Case, Count, F, IntegerField, Q, Sum, When
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
 
+from comments.cache import bump_comments_version
+from comments.tree import ArrayTreeBackend, get_tree_backend
 
-class CommentManager(models.Manager):
-    def comments_count(self, content_type, object_id):
-        return self.get_queryset().filter(content_type=content_type, object_id=object_id).count()
 
-    def remove_comment(self, comment_id):
-        comment_to_remove = self.get_queryset().filter(pk=comment_id)
+# maximum number of comments marked as removed by one UPDATE (in one transaction)...
+
+COMMENTS_REMOVE_CHUNK_SIZE = getattr(settings, 'COMMENTS_REMOVE_CHUNK_SIZE', 1000)
+
+# text search configuration of PostgreSQL used for "search_vector" column (see migration 0004)...
+
+COMMENTS_SEARCH_CONFIG = getattr(settings, 'COMMENTS_SEARCH_CONFIG', 'simple')
+
+
+def _not_removed_count():
+    return Sum(Case(When(is_removed=False, then=1), default=0, output_field=IntegerField()))
+
+
+def _counts_by_object(queryset, *fields):
+    """
+    Return values_list of ``fields``, total and not removed counts grouped by ``fields``.
+
+    """
+    return (
+        queryset
+        .order_by()
+        .values_list(*fields)
+        .annotate(total=Count('pk'))
+        .annotate(not_removed=_not_removed_count())
+    )
+
+
+def _count_comments(queryset):
+    counts = queryset.aggregate(total=Count('pk'), not_removed=_not_removed_count())
+
+    return counts['total'], counts['not_removed'] or 0
+
+
+class CommentQuerySet(models.QuerySet):
+    def for_tree(self):
+        """
+        Fetch authors and content types together with comments and defer columns
+        of authors which are not used by comment templates.
+
+        """
+        return self.select_related('user', 'content_type').defer('user__password', 'user__last_login')
+
+    def rows(self):
+        """
+        Return list of read-only CommentRow, only columns used by comment templates
+        and username of author are selected (no model instances are built).
+
+        """
+        from comments.models import CommentRow
+
+        return [CommentRow(*values) for values in self.values_list(*CommentRow.fields)]
+
+    def search(self, query, content_type=None, object_id=None):
+        """
+        Full-text search of comments by "search_vector" column (GIN index), comments are
+        ordered by rank which is available as "search_rank" attribute.
+
+        """
+        queryset = self
+
+        if content_type is not None:
+            queryset = queryset.filter(content_type=content_type)
+
+        if object_id is not None:
+            queryset = queryset.filter(object_id=object_id)
+
+        search_vector = '{0}.search_vector'.format(connections[self.db].ops.quote_name(self.model._meta.db_table))
+        search_query = 'plainto_tsquery(%s::regconfig, %s)'
+
+        return queryset.extra(
+            select={'search_rank': 'ts_rank({0}, {1})'.format(search_vector, search_query)},
+            select_params=[COMMENTS_SEARCH_CONFIG, query],
+            where=['{0} @@ {1}'.format(search_vector, search_query)],
+            params=[COMMENTS_SEARCH_CONFIG, query],
+            order_by=['-search_rank']
+        )
+
+
+class CommentManager(models.Manager.from_queryset(CommentQuerySet)):
+    def _db_for_write(self):
+        """
+        Return database of raw SQL writes, they are not routed as querysets and reads
+        of manager may go to replica (see CommentRouter).
+
+        """
+        return self._db or router.db_for_write(self.model, **self._hints)
+
+    def comments_count(self, content_type, object_id, include_removed=True):
+        counter = apps.get_model('comments', 'CommentCounter').objects.get_counter(
+            getattr(content_type, 'pk', content_type),
+            object_id
+        )
+
+        return counter.total if include_removed else counter.not_removed
+
+    def prefetch_comments_count(self, objects, to_attr='comments_count', include_removed=True):
+        """
+        Attach count of comments to every object of ``objects`` (list or queryset, objects
+        may be of different models) as ``to_attr`` attribute, one query is made per model.
+        Return list of objects.
+
+        """
+        from django.contrib.contenttypes.models import ContentType
+
+        objects = list(objects)
+        objects_by_model = defaultdict(list)
+
+        for obj in objects:
+            objects_by_model[type(obj)].append(obj)
+
+        content_types = ContentType.objects.get_for_models(*objects_by_model)
+        counter_manager = apps.get_model('comments', 'CommentCounter').objects
+
+        for model, model_objects in objects_by_model.items():
+            counters = counter_manager.get_counters(content_types[model].pk, [obj.pk for obj in model_objects])
+
+            for obj in model_objects:
+                counter = counters[obj.pk]
+                setattr(obj, to_attr, counter.total if include_removed else counter.not_removed)
+
+        return objects
+
+    def prefetch_top_comments(self, objects, limit=3, replies=0, to_attr='top_comments', include_removed=False):
+        """
+        Attach the latest ``limit`` root comments of every object of ``objects`` (objects may be
+        of different models) followed by the first ``replies`` replies of every root comment
+        as ``to_attr`` list (threads are ordered from the newest). Comments are selected by one
+        query with ROW_NUMBER window per object (and per root comment for replies) and their
+        authors by one more query, so number of queries does not depend on number of objects.
+        Return list of objects.
+
+        """
+        from django.contrib.contenttypes.models import ContentType
+
+        objects = list(objects)
+        objects_by_model = defaultdict(list)
+
+        for obj in objects:
+            objects_by_model[type(obj)].append(obj)
+
+        if not objects:
+            return objects
+
+        content_types = ContentType.objects.get_for_models(*objects_by_model)
+        qn = connections[self.db].ops.quote_name
+        opts = self.model._meta
+
+        conditions = []
+        params = []
+
+        for model, model_objects in objects_by_model.items():
+            conditions.append('(content_type_id = %s AND object_id = ANY(%s))')
+            params.extend([content_types[model].pk, [obj.pk for obj in model_objects]])
+
+        not_removed = '' if include_removed else ' AND NOT is_removed'
+
+        sql = (
+            'WITH roots AS (SELECT id FROM ('
+            'SELECT id, ROW_NUMBER() OVER (PARTITION BY content_type_id, object_id ORDER BY id DESC) AS position '
+            'FROM {table} WHERE parent_id IS NULL{not_removed} AND ({conditions})'
+            ') AS ranked WHERE position <= %s)'
+        )
+        params.append(limit)
+        selected = 'SELECT id FROM roots'
+
+        if replies:
+            sql += (
+                ', replies AS (SELECT id FROM ('
+                'SELECT id, ROW_NUMBER() OVER (PARTITION BY parent_id ORDER BY id) AS position '
+                'FROM {table} WHERE parent_id IN (SELECT id FROM roots){not_removed}'
+                ') AS ranked WHERE position <= %s)'
+            )
+            params.append(replies)
+            selected += ' UNION ALL SELECT id FROM replies'
+
+        sql = (sql + ' SELECT {columns} FROM {table} WHERE id IN ({selected})').format(
+            table=qn(opts.db_table),
+            not_removed=not_removed,
+            conditions=' OR '.join(conditions),
+            columns=', '.join(qn(field.column) for field in opts.local_concrete_fields),
+            selected=selected
+        )
+
+        comments = list(self.raw(sql, params).using(self.db))
+        users = opts.get_field('user').related_model._default_manager.using(self.db).in_bulk(
+            set(comment.user_id for comment in comments)
+        )
+        comments_by_object = defaultdict(list)
+
+        # threads from the newest, replies in tree order...
+        for comment in sorted(comments, key=lambda comment: (-comment.path[0], comment.path)):
+            comment.user = users[comment.user_id]
+            comments_by_object[(comment.content_type_id, comment.object_id)].append(comment)
+
+        for model, model_objects in objects_by_model.items():
+            for obj in model_objects:
+                setattr(obj, to_attr, comments_by_object.get((content_types[model].pk, obj.pk), []))
+
+        return objects
+
+    def mark_removed(self, queryset):
+        """
+        Mark comments of queryset as removed by chunks, see _remove.
+
+        """
+        sql, params = queryset.order_by().values('pk').query.sql_with_params()
+        return self._remove('id IN ({0})'.format(sql), list(params))
+
+    def _remove(self, where, params, chunk_size=None):
+        """
+        Mark comments matching ``where`` SQL condition as removed (with "removed_at" set to time
+        of database unless it is set already) and update counters of their
+        objects. Ids of matching comments are selected once, then comments are updated by
+        chunks of ``chunk_size`` ids (ordered by id), every chunk is one UPDATE ... RETURNING
+        by primary key in its own transaction, so rows of large tree are not locked all at
+        once and the condition is not evaluated again for every chunk. Return comments
+        (only "id", "path", "content_type" and "object_id" are loaded) ordered by "path",
+        including comments which were removed before.
+
+        """
+        chunk_size = chunk_size or COMMENTS_REMOVE_CHUNK_SIZE
+        db = self._db_for_write()
+        connection = connections[db]
+        counter_manager = apps.get_model('comments', 'CommentCounter').objects
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+
+        sql = (
+            'UPDATE {table} AS comment SET is_removed = true, removed_at = COALESCE(comment.removed_at, clock_timestamp()) '
+            'FROM (SELECT id, is_removed FROM {table} WHERE id = ANY(%s) ORDER BY id FOR UPDATE) AS old '
+            'WHERE comment.id = old.id '
+            'RETURNING comment.id, comment.path, comment.content_type_id, comment.object_id, old.is_removed'
+        ).format(table=table)
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id FROM {table} WHERE {where} ORDER BY id'.format(table=table, where=where), params)
+            matching = [row[0] for row in cursor.fetchall()]
+
+        removed = []
+
+        for start in range(0, len(matching), chunk_size):
+            with transaction.atomic(using=db):
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, [matching[start:start + chunk_size]])
+                    rows = cursor.fetchall()
+
+                changes = defaultdict(int)
+
+                for comment_id, path, content_type_id, object_id, was_removed in rows:
+                    if not was_removed:
+                        changes[(content_type_id, object_id)] += 1
+
+                for (content_type_id, object_id), count in changes.items():
+                    counter_manager.change(content_type_id, object_id, not_removed=-count)
+                    bump_comments_version(content_type_id, object_id, using=db)
+
+            removed.extend(
+                self.model(id=comment_id, path=path, content_type_id=content_type_id, object_id=object_id, is_removed=True)
+                for comment_id, path, content_type_id, object_id, was_removed in rows
+            )
+
+        removed.sort(key=lambda comment: comment.path)
+
+        return removed
+
+    def changes_since(self, content_type, object_id, since_id=None, since=None):
+        """
+        Return comments of object added after cursor (id greater than ``since_id`` or published
+        after ``since``, so comments with lower ids committed later are returned too) ordered
+        by id, so parents go before their replies, and comments removed after ``since``
+        (none without ``since``). Cursors overlap, so the same changes may be returned again.
+
+        """
+        comments = self.get_queryset().filter(content_type=content_type, object_id=object_id)
+
+        if since_id is not None and since is not None:
+            added = comments.filter(Q(pk__gt=since_id) | Q(pub_date__gt=since))
+        elif since_id is not None:
+            added = comments.filter(pk__gt=since_id)
+        elif since is not None:
+            added = comments.filter(pub_date__gt=since)
+        else:
+            added = comments
+
+        removed = comments.filter(removed_at__gt=since) if since is not None else comments.none()
+
+        return added.order_by('pk'), removed
+
+    def database_time(self):
+        """
+        Return current time of database (timestamps of removal are taken from its clock).
+
+        """
+        with connections[self._db_for_write()].cursor() as cursor:
+            cursor.execute('SELECT clock_timestamp()')
+            return cursor.fetchone()[0]
+
+    def thread_page(self, content_type, object_id, limit=None, after=None, archived=False, rows=False):
+        """
+        Return comments of the first ``limit`` root threads of object whose root id
+        is greater than ``after`` and the cursor for the next page (None for last page).
+        Page is selected by range on "path" (keyset on path[1]), so it costs the same
+        for the first and for the last page.
+        If ``archived`` is set, archived threads of object are paged together with comments
+        and list of both ordered by "path" is returned instead of queryset (list of
+        CommentRow if ``rows`` is set).
+
+        """
+        querysets = [self.get_queryset().filter(content_type=content_type, object_id=object_id)]
+        next_after = None
+
+        if archived:
+            querysets.append(apps.get_model('comments', 'ArchivedComment').objects.filter(
+                content_type=content_type,
+                object_id=object_id
+            ))
+
+        if limit is not None:
+            root_ids = []
+
+            for comments in querysets:
+                roots = comments.filter(parent__isnull=True)
+
+                if after is not None:
+                    roots = roots.filter(pk__gt=after)
+
+                root_ids.extend(roots.order_by('pk').values_list('pk', flat=True)[:limit + 1])
+
+            # ids are kept by archival, so roots of both tables are ordered together...
+            root_ids = sorted(root_ids)[:limit + 1]
+
+            if not root_ids:
+                return (self.none(), None) if not archived else ([], None)
+
+            if len(root_ids) > limit:
+                next_after = root_ids[limit - 1]
+                querysets = [comments.filter(path__lt=[next_after + 1]) for comments in querysets]
+
+        if after is not None:
+            querysets = [comments.filter(path__gte=[after + 1]) for comments in querysets]
+
+        if not archived:
+            return querysets[0].for_tree(), next_after
+
+        return self._merge_by_path(querysets, rows), next_after
+
+    def descendants(self, comment):
+        """
+        Return descendants of comment (``comment`` needs "path", "content_type" and "object_id"),
+        subtree is selected by tree backend (see COMMENTS_TREE_BACKEND). Descendants of
+        ArchivedComment are selected from its table by range on "path".
+
+        """
+        archive_model = apps.get_model('comments', 'ArchivedComment')
+
+        if isinstance(comment, archive_model):
+            return ArrayTreeBackend().subtree(archive_model.objects.all(), comment).exclude(pk=comment.pk)
+
+        return get_tree_backend().subtree(self.get_queryset(), comment).exclude(pk=comment.pk)
 
-        if not comment_to_remove:
+    def bulk_create_tree(self, items, batch_size=1000, known=None):
+        """
+        Insert comments of ``items`` - iterable of (key, parent_key, comment), where key and
+        parent_key are external keys of comment and its parent (parent_key is None for root
+        comments); parent may come after its children. Ids are taken from the sequence and
+        paths are computed in memory, so one INSERT is made per ``batch_size`` comments.
+        "pub_date" of comments is kept (it is set to now only if it is empty), "removed_at"
+        of removed comments is set to now if it is empty.
+
+        Every batch is inserted together with changes of counters in its own transaction, so
+        rows are not locked for the whole import. ``known`` - mapping {key: (id, path)} of
+        inserted comments, it is updated after every committed batch. Pass a persistent
+        mapping (e.g. shelve) to keep memory of large import small and to resume interrupted
+        import: comments whose keys are in ``known`` are skipped (comments waiting for their
+        parents are kept in memory until the parent comes).
+        Return ``known``.
+
+        """
+        opts = self.model._meta
+        db = self._db_for_write()
+        tree_backend = get_tree_backend()
+        ids = self._allocate_ids(batch_size)
+        known = {} if known is None else known
+        pending = defaultdict(list)
+        batch = []
+        # keys of comments of current batch, they are added to ``known`` after commit...
+        batch_known = {}
+
+        def flush():
+            counts = defaultdict(lambda: [0, 0])
+
+            for comment in batch:
+                count = counts[(comment.content_type_id, comment.object_id)]
+                count[0] += 1
+                count[1] += 0 if comment.is_removed else 1
+
+            counter_manager = apps.get_model('comments', 'CommentCounter').objects
+
+            with transaction.atomic(using=db):
+                # bulk_create would overwrite "pub_date" (auto_now_add) of imported comments,
+                # raw insert keeps values of all fields as they are...
+                self._insert(batch, fields=opts.local_concrete_fields, using=db, raw=True)
+
+                for (content_type_id, object_id), (total, not_removed) in counts.items():
+                    counter_manager.change(content_type_id, object_id, total=total, not_removed=not_removed)
+                    bump_comments_version(content_type_id, object_id, using=db)
+
+            known.update(batch_known)
+            del batch[:]
+            batch_known.clear()
+
+        def lookup(key):
+            return batch_known[key] if key in batch_known else known.get(key)
+
+        for item in items:
+            key, parent_key, comment = item
+
+            if parent_key is not None and lookup(parent_key) is None:
+                pending[parent_key].append(item)
+                continue
+
+            stack = [item]
+
+            while stack:
+                key, parent_key, comment = stack.pop()
+
+                if key in batch_known:
+                    raise ValueError('Comment with key {0!r} is given twice.'.format(key))
+
+                if key not in known:
+                    parent_id, parent_path = lookup(parent_key) if parent_key is not None else (None, None)
+
+                    comment.pk = next(ids)
+                    comment.parent_id = parent_id
+                    comment.path = tree_backend.build_path(parent_path, comment.pk)
+
+                    if comment.pub_date is None:
+                        comment.pub_date = timezone.now()
+
+                    if comment.is_removed and comment.removed_at is None:
+                        comment.removed_at = timezone.now()
+
+                    batch_known[key] = (comment.pk, comment.path)
+                    batch.append(comment)
+
+                stack.extend(pending.pop(key, ()))
+
+                if len(batch) >= batch_size:
+                    flush()
+
+        if batch:
+            flush()
+
+        if pending:
+            raise ValueError('Parents of comments do not exist: {0!r}.'.format(list(pending)[:10]))
+
+        return known
+
+    def _allocate_ids(self, batch_size):
+        """
+        Yield ids taken from the sequence of comments table by ``batch_size`` at once.
+
+        """
+        opts = self.model._meta
+        db = self._db_for_write()
+        connection = connections[db]
+
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+                    [opts.db_table, opts.pk.column, batch_size]
+                )
+                allocated = [row[0] for row in cursor.fetchall()]
+
+            for pk in allocated:
+                yield pk
+
+    def with_archived(self, comments, content_type, object_id, rows=False):
+        """
+        Return list of ``comments`` of object merged by "path" with its archived threads
+        (list of CommentRow if ``rows`` is set).
+
+        """
+        archived = apps.get_model('comments', 'ArchivedComment').objects.filter(
+            content_type=content_type,
+            object_id=object_id
+        )
+
+        return self._merge_by_path([comments, archived], rows)
+
+    def _merge_by_path(self, querysets, rows=False):
+        querysets = [queryset.for_tree() for queryset in querysets]
+
+        if rows:
+            querysets = [queryset.rows() for queryset in querysets]
+
+        # all lists are ordered by path, so sort only merges them...
+        return sorted([comment for queryset in querysets for comment in queryset], key=lambda comment: comment.path)
+
+    def archive_batch(self, before=None, content_type=None, object_ids=None, after=0, batch_size=100):
+        """
+        Move next ``batch_size`` root threads (root id greater than ``after``) which had no
+        comments since ``before`` and belong to ``object_ids`` of ``content_type`` (if given)
+        to ArchivedComment table in one transaction. Threads are moved whole, so reads
+        never see part of thread. Return id of the last examined root (None if there are
+        no roots left, pass it as ``after`` to the next call) and number of moved comments.
+
+        """
+        db = self._db_for_write()
+        connection = connections[db]
+        qn = connection.ops.quote_name
+        archive_model = apps.get_model('comments', 'ArchivedComment')
+
+        roots = self.get_queryset().filter(parent__isnull=True, pk__gt=after)
+
+        if before is not None:
+            roots = roots.filter(pub_date__lt=before)
+
+        if content_type is not None:
+            roots = roots.filter(content_type=content_type)
+
+        if object_ids is not None:
+            roots = roots.filter(object_id__in=object_ids)
+
+        root_ids = list(roots.order_by('pk').values_list('pk', flat=True)[:batch_size])
+
+        if not root_ids:
+            return None, 0
+
+        table = qn(self.model._meta.db_table)
+        columns = ', '.join(qn(field.column) for field in self.model._meta.local_concrete_fields)
+        cold = 'SELECT root.id FROM unnest(%s::integer[]) AS root(id)'
+        params = [root_ids]
+
+        if before is not None:
+            cold += (
+                ' WHERE NOT EXISTS (SELECT 1 FROM {table} AS reply '
+                'WHERE reply.path @> ARRAY[root.id] AND reply.pub_date >= %s)'
+            ).format(table=table)
+            params.append(before)
+
+        sql = (
+            'WITH cold AS ({cold}), '
+            'moved AS (DELETE FROM {table} AS comment USING cold WHERE comment.path @> ARRAY[cold.id] RETURNING comment.*) '
+            'INSERT INTO {archive} ({columns}, archived_at) SELECT {columns}, %s FROM moved '
+            'RETURNING content_type_id, object_id'
+        ).format(cold=cold, table=table, archive=qn(archive_model._meta.db_table), columns=columns)
+
+        with transaction.atomic(using=db):
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params + [timezone.now()])
+                rows = cursor.fetchall()
+
+            # counters include archived comments, only rendered lists are changed...
+            for content_type_id, object_id in set(rows):
+                bump_comments_version(content_type_id, object_id, using=db)
+
+        return root_ids[-1], len(rows)
+
+    def archive_threads(self, before=None, content_type=None, object_ids=None, after=0, batch_size=100):
+        """
+        Archive all matching root threads batch by batch (see archive_batch).
+        Return number of moved comments.
+
+        """
+        archived = 0
+
+        while after is not None:
+            after, moved = self.archive_batch(before, content_type, object_ids, after, batch_size)
+            archived += moved
+
+        return archived
+
+    def remove_comment(self, comment_id):
+        if comment_id is None:
             raise ObjectDoesNotExist('Comment with such id ({0}) does not exist.'.format(comment_id))
 
-        comment_to_remove.update(is_removed=True)
+        removed = self._remove('id = %s', [int(comment_id)])
+
+        if not removed:
+            raise ObjectDoesNotExist('Comment with such id ({0}) does not exist.'.format(comment_id))
 
-        return comment_to_remove
+        return removed
 
     def remove_comment_tree(self, parent_id):
-        comments_to_remove = self.get_queryset().filter(path__contains=[parent_id])
+        if parent_id is None:
+            raise ObjectDoesNotExist('Comments with such parent_id ({0}) does not exists.'.format(parent_id))
 
-        if not comments_to_remove:
+        try:
+            parent = self.get_queryset().only('path', 'content_type', 'object_id').get(pk=int(parent_id))
+        except self.model.DoesNotExist:
             raise ObjectDoesNotExist('Comments with such parent_id ({0}) does not exists.'.format(parent_id))
 
-        comments_to_remove.update(is_removed=True)
+        removed = self._remove(*get_tree_backend().subtree_sql(parent))
+
+        return removed
+
+
+class CommentCounterManager(models.Manager):
+    def _comments(self, model_name):
+        """
+        Return queryset of comments (or archived comments) read from database which counters
+        are written to, so counters are never built from lagged replica.
+
+        """
+        return apps.get_model('comments', model_name).objects.using(router.db_for_write(self.model))
+
+    def get_counter(self, content_type_id, object_id):
+        """
+        Return counter of object, missing counter is counted from comments and is not saved
+        (counters are written by change and rebuild_all only, so reads never write).
+
+        """
+        try:
+            return self.get_queryset().get(content_type_id=content_type_id, object_id=object_id)
+        except self.model.DoesNotExist:
+            total, not_removed = self._count(content_type_id, object_id)
+
+            return self.model(
+                content_type_id=content_type_id,
+                object_id=object_id,
+                total=total,
+                not_removed=not_removed
+            )
+
+    def get_counters(self, content_type_id, object_ids):
+        """
+        Return dict {object_id: counter} for objects of one content type, missing counters
+        are counted by one aggregate query and are not saved (see get_counter).
+
+        """
+        object_ids = set(object_ids)
+        counters = {
+            counter.object_id: counter
+            for counter in self.get_queryset().filter(content_type_id=content_type_id, object_id__in=object_ids)
+        }
+        missing = object_ids.difference(counters)
+
+        if missing:
+            counted = {
+                object_id: self.model(content_type_id=content_type_id, object_id=object_id)
+                for object_id in missing
+            }
+            for model_name in ('Comment', 'ArchivedComment'):
+                counts = _counts_by_object(
+                    self._comments(model_name).filter(content_type_id=content_type_id, object_id__in=missing),
+                    'object_id'
+                )
+
+                for object_id, total, not_removed in counts:
+                    counted[object_id].total += total
+                    counted[object_id].not_removed += not_removed
+
+            counters.update(counted)
+
+        return counters
+
+    def change(self, content_type_id, object_id, total=0, not_removed=0):
+        """
+        Add ``total`` and ``not_removed`` to counter of object. Must be called after
+        the comments are changed and in the same transaction.
+
+        """
+        updated = self.get_queryset().filter(content_type_id=content_type_id, object_id=object_id).update(
+            total=F('total') + total,
+            not_removed=F('not_removed') + not_removed
+        )
+
+        if not updated:
+            self.rebuild(content_type_id, object_id)
+
+    def rebuild(self, content_type_id, object_id):
+        total, not_removed = self._count(content_type_id, object_id)
+
+        counter, created = self.update_or_create(
+            content_type_id=content_type_id,
+            object_id=object_id,
+            defaults={'total': total, 'not_removed': not_removed}
+        )
+
+        return counter
+
+    def _count(self, content_type_id, object_id):
+        """
+        Return (total, not_removed) counted from comments of object.
+
+        """
+        total, not_removed = 0, 0
+
+        # archived comments are counted too...
+        for model_name in ('Comment', 'ArchivedComment'):
+            comments = self._comments(model_name).filter(content_type_id=content_type_id, object_id=object_id)
+            counts = _count_comments(comments)
+            total += counts[0]
+            not_removed += counts[1]
+
+        return total, not_removed
+
+    def rebuild_all(self, batch_size=1000):
+        """
+        Rebuild counters of all objects from scratch (archived comments are counted too).
+
+        """
+        counts = _counts_by_object(self._comments('Comment'), 'content_type_id', 'object_id')
+
+        with transaction.atomic(using=self.db):
+            self.get_queryset().delete()
+
+            counters = []
+            rebuilt = 0
+
+            for content_type_id, object_id, total, not_removed in counts.iterator():
+                counters.append(self.model(
+                    content_type_id=content_type_id,
+                    object_id=object_id,
+                    total=total,
+                    not_removed=not_removed
+                ))
+
+                if len(counters) >= batch_size:
+                    self.bulk_create(counters)
+                    rebuilt += len(counters)
+                    counters = []
+
+            self.bulk_create(counters)
+            rebuilt += len(counters)
+
+            rebuilt += self._add_archived_counts()
+
+        return rebuilt
+
+    def _add_archived_counts(self):
+        """
+        Add counts of archived comments to counters, missing counters are created.
+        Return number of created counters.
+
+        """
+        archived = _counts_by_object(self._comments('ArchivedComment'), 'content_type_id', 'object_id')
+        connection = connections[archived.db]
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        archived, params = archived.query.sql_with_params()
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'UPDATE {table} AS counter SET total = counter.total + archived.total, '
+                'not_removed = counter.not_removed + archived.not_removed '
+                'FROM ({archived}) AS archived '
+                'WHERE counter.content_type_id = archived.content_type_id AND counter.object_id = archived.object_id'.format(
+                    table=table,
+                    archived=archived
+                ),
+                params
+            )
+            cursor.execute(
+                'INSERT INTO {table} (content_type_id, object_id, total, not_removed) '
+                'SELECT archived.content_type_id, archived.object_id, archived.total, archived.not_removed '
+                'FROM ({archived}) AS archived WHERE NOT EXISTS (SELECT 1 FROM {table} AS counter '
+                'WHERE counter.content_type_id = archived.content_type_id AND counter.object_id = archived.object_id)'.format(
+                    table=table,
+                    archived=archived
+                ),
+                params
+            )
 
-        return comments_to_remove
+            return cursor.rowcount
@@ -0,0 +1,138 @@
+import threading
+import timeit
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+# backend which receives timing events of comments (views, template tags)...
+
+COMMENTS_METRICS_BACKEND = getattr(settings, 'COMMENTS_METRICS_BACKEND', 'comments.metrics.NullBackend')
+
+
+class BaseBackend(object):
+    """
+    Receiver of timing events. Event has a name ("comments.query", "comments.collapse",
+    "comments.annotate", "comments.render", "comments.cache", "comments.count", "comments.view"),
+    duration in seconds (None for events without duration) and data (tag or view name, rows, hit...).
+    "comments.annotate" of "annotate_tree" filter is nested in "comments.render" of the tag.
+
+    """
+
+    enabled = True
+
+    def emit(self, event, duration=None, **data):
+        raise NotImplementedError
+
+
+class NullBackend(BaseBackend):
+    enabled = False
+
+    def emit(self, event, duration=None, **data):
+        pass
+
+
+class MetricEvent(object):
+    __slots__ = ('name', 'duration', 'data')
+
+    def __init__(self, name, duration, data):
+        self.name = name
+        self.duration = duration
+        self.data = data
+
+    def __repr__(self):
+        return '<MetricEvent: {0}, duration {1}, data {2}>'.format(self.name, self.duration, self.data)
+
+
+class InMemoryBackend(BaseBackend):
+    """
+    Keep events in memory (for tests and debugging).
+
+    """
+
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def emit(self, event, duration=None, **data):
+        with self.lock:
+            self.events.append(MetricEvent(event, duration, data))
+
+    def filter(self, name):
+        return [event for event in self.events if event.name == name]
+
+    def clear(self):
+        with self.lock:
+            self.events = []
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+
+    if _backend is None:
+        _backend = import_string(COMMENTS_METRICS_BACKEND)()
+
+    return _backend
+
+
+class Timer(object):
+    __slots__ = ('backend', 'event', 'data', 'start')
+
+    def __init__(self, backend, event, data):
+        self.backend = backend
+        self.event = event
+        self.data = data
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.backend.emit(self.event, timeit.default_timer() - self.start, **self.data)
+
+    def set(self, **data):
+        self.data.update(data)
+
+
+class NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def set(self, **data):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def enabled():
+    return get_backend().enabled
+
+
+def timer(event, **data):
+    """
+    Return context manager which emits ``event`` with duration of its block.
+    Data may be added inside of block by "set" method of timer.
+
+    """
+    backend = get_backend()
+
+    if not backend.enabled:
+        return NULL_TIMER
+
+    return Timer(backend, event, data)
+
+
+def emit(event, **data):
+    backend = get_backend()
+
+    if backend.enabled:
+        backend.emit(event, **data)
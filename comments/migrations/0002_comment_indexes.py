@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    # indexes are built concurrently (outside of transaction), so writes to comments
+    # table are not blocked while indexes of large table are built...
+    atomic = False
+
+    dependencies = [
+        ('comments', '0001_initial'),
+    ]
+
+    operations = [
+        # comments of object ordered by path (comment tree)...
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY comments_comment_tree ON comments_comment (content_type_id, object_id, path)',
+            'DROP INDEX CONCURRENTLY comments_comment_tree',
+        ),
+        # subtree lookups (path @> ARRAY[id])...
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY comments_comment_path_gin ON comments_comment USING gin (path)',
+            'DROP INDEX CONCURRENTLY comments_comment_path_gin',
+        ),
+        # not removed comments of object...
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY comments_comment_not_removed ON comments_comment (content_type_id, object_id, path) '
+            'WHERE NOT is_removed',
+            'DROP INDEX CONCURRENTLY comments_comment_not_removed',
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0002_comment_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='removed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Removal date'),
+        ),
+        # comments removed before this migration get their publication date...
+        migrations.RunSQL(
+            'UPDATE comments_comment SET removed_at = pub_date WHERE is_removed',
+            migrations.RunSQL.noop,
+        ),
+        # comments of object removed after sync cursor...
+        migrations.RunSQL(
+            'CREATE INDEX comments_comment_removed_at ON comments_comment (content_type_id, object_id, removed_at) '
+            'WHERE removed_at IS NOT NULL',
+            'DROP INDEX comments_comment_removed_at',
+        ),
+    ]
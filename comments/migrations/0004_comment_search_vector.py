@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+# must be the same as COMMENTS_SEARCH_CONFIG of comments.managers...
+
+SEARCH_CONFIG = getattr(settings, 'COMMENTS_SEARCH_CONFIG', 'simple')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0003_comment_removed_at'),
+    ]
+
+    operations = [
+        # search vector is not a model field, it is kept up to date by trigger...
+        migrations.RunSQL(
+            'ALTER TABLE comments_comment ADD COLUMN search_vector tsvector',
+            'ALTER TABLE comments_comment DROP COLUMN search_vector',
+        ),
+        migrations.RunSQL(
+            'CREATE TRIGGER comments_comment_search_vector BEFORE INSERT OR UPDATE OF comment ON comments_comment '
+            'FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(search_vector, \'pg_catalog.{0}\', comment)'.format(
+                SEARCH_CONFIG
+            ),
+            'DROP TRIGGER comments_comment_search_vector ON comments_comment',
+        ),
+        migrations.RunSQL(
+            [('UPDATE comments_comment SET search_vector = to_tsvector(%s::regconfig, comment)', [SEARCH_CONFIG])],
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX comments_comment_search ON comments_comment USING gin (search_vector)',
+            'DROP INDEX comments_comment_search',
+        ),
+    ]
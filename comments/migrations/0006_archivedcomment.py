@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('comments', '0005_comment_pub_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedComment',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField(verbose_name='Object ID')),
+                ('comment', models.TextField(verbose_name='Comment')),
+                ('pub_date', models.DateTimeField(verbose_name='Date')),
+                ('is_removed', models.BooleanField(default=False, verbose_name='Is removed')),
+                ('removed_at', models.DateTimeField(blank=True, null=True, verbose_name='Removal date')),
+                ('path', django.contrib.postgres.fields.ArrayField(base_field=models.PositiveIntegerField(), null=True, size=None)),
+                ('archived_at', models.DateTimeField(auto_now_add=True, verbose_name='Archival date')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contenttypes.ContentType', verbose_name='Content type')),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='comments.ArchivedComment', verbose_name='Parent')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'ordering': ('path',),
+                'db_table': 'comments_archived_comment',
+                'verbose_name': 'Archived comment',
+                'verbose_name_plural': 'Archived comments',
+            },
+        ),
+        # archived comments of object ordered by path (comment tree)...
+        migrations.RunSQL(
+            'CREATE INDEX comments_archived_comment_tree ON comments_archived_comment (content_type_id, object_id, path)',
+            'DROP INDEX comments_archived_comment_tree',
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+from comments.tree import LtreeTreeBackend
+
+
+# "tree_path" ltree column is created only for LtreeTreeBackend (other backends do not read it
+# and would pay for its trigger), to switch backend later use "ltree_comments" command...
+
+LTREE = getattr(settings, 'COMMENTS_TREE_BACKEND', None) == 'comments.tree.LtreeTreeBackend'
+
+
+def install_ltree(apps, schema_editor):
+    connection = schema_editor.connection
+
+    if LTREE and not LtreeTreeBackend().is_installed(connection):
+        # migration is not atomic, so comments are filled by batches and index is built concurrently...
+        LtreeTreeBackend().install(connection, concurrently=not connection.in_atomic_block)
+
+
+def uninstall_ltree(apps, schema_editor):
+    LtreeTreeBackend().uninstall(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('comments', '0006_archivedcomment'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_ltree, uninstall_ltree),
+    ]
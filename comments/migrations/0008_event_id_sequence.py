@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('comments', '0007_comment_tree_path'),
+    ]
+
+    # ids of events published by PostgresBroker...
+    operations = [
+        migrations.RunSQL(
+            'CREATE SEQUENCE comments_event_id_seq',
+            'DROP SEQUENCE comments_event_id_seq',
+        ),
+    ]
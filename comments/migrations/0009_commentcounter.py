@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('comments', '0008_event_id_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommentCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField(verbose_name='Object ID')),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='Total')),
+                ('not_removed', models.PositiveIntegerField(default=0, verbose_name='Not removed')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType', verbose_name='Content type')),
+            ],
+            options={
+                'db_table': 'comments_comment_counter',
+                'verbose_name': 'Comment counter',
+                'verbose_name_plural': 'Comment counters',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='commentcounter',
+            unique_together=set([('content_type', 'object_id')]),
+        ),
+        # counters of existing comments (archived comments are counted too)...
+        migrations.RunSQL(
+            'INSERT INTO comments_comment_counter (content_type_id, object_id, total, not_removed) '
+            'SELECT content_type_id, object_id, count(*), sum(CASE WHEN is_removed THEN 0 ELSE 1 END) '
+            'FROM (SELECT content_type_id, object_id, is_removed FROM comments_comment '
+            'UNION ALL SELECT content_type_id, object_id, is_removed FROM comments_archived_comment) AS comment '
+            'GROUP BY content_type_id, object_id',
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -1,12 +1,15 @@
 from django.conf import settings
-from django.db import models
+from django.db import connections, models, router, transaction
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.postgres.fields import ArrayField
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 
-from comments.managers import CommentManager
+from comments.cache import bump_comments_version
+from comments.managers import CommentManager, CommentCounterManager, CommentQuerySet
+from comments.tree import get_tree_backend, MAX_LENGTH_OF_COMMENT_TREE
 
 
 # get auth user model
@@ -21,9 +24,26 @@ if AUTH_USER_MODEL is None:
 
 COMMENTS_MAX_DEPTH = getattr(settings, 'COMMENTS_MAX_DEPTH', 10)
 
-# maximum length of "path" array (in database)...
+# number of root threads rendered at once (None - render all comments of object)...
 
-MAX_LENGTH_OF_COMMENT_TREE = getattr(settings, 'MAX_LENGTH_OF_COMMENT_TREE', None)
+COMMENTS_THREADS_PER_PAGE = getattr(settings, 'COMMENTS_THREADS_PER_PAGE', None)
+
+# number of rendered replies of comment, the rest are loaded by "more replies" button (None - all)...
+
+COMMENTS_MAX_REPLIES = getattr(settings, 'COMMENTS_MAX_REPLIES', None)
+
+# hide replies deeper than COMMENTS_MAX_DEPTH behind "more replies" button...
+
+COMMENTS_COLLAPSE_DEEP_REPLIES = getattr(settings, 'COMMENTS_COLLAPSE_DEEP_REPLIES', False)
+COMMENTS_COLLAPSE_DEPTH = COMMENTS_MAX_DEPTH if COMMENTS_COLLAPSE_DEEP_REPLIES else None
+
+# read archived threads together with comments of object (see ArchivedComment)...
+
+COMMENTS_INCLUDE_ARCHIVED = getattr(settings, 'COMMENTS_INCLUDE_ARCHIVED', False)
+
+# read comment lists as CommentRow (only columns used by comment templates) instead of Comment models...
+
+COMMENTS_ROW_MODE = getattr(settings, 'COMMENTS_ROW_MODE', False)
 
 
 class Comment(models.Model):
@@ -32,8 +52,9 @@ class Comment(models.Model):
     object_id = models.PositiveIntegerField(verbose_name=_('Object ID'))
     obj = GenericForeignKey('content_type', 'object_id')
     comment = models.TextField(verbose_name=_('Comment'))
-    pub_date = models.DateTimeField(verbose_name=_('Date'), auto_now_add=True)
+    pub_date = models.DateTimeField(verbose_name=_('Date'), auto_now_add=True, db_index=True)
     is_removed = models.BooleanField(verbose_name=_('Is removed'), default=False)
+    removed_at = models.DateTimeField(verbose_name=_('Removal date'), null=True, blank=True, editable=False)
     path = ArrayField(models.PositiveIntegerField(), null=True, editable=False)
 
     parent = models.ForeignKey(
@@ -57,28 +78,98 @@ class Comment(models.Model):
 
     def save(self, *args, **kwargs):
         skip_build_tree = kwargs.pop('skip_build_tree', False)
-        super(Comment, self).save(*args, **kwargs)
+        created = self.pk is None
+
+        # path of new comment is computed by INSERT (see _do_insert), otherwise id is known here...
+        self._build_tree_on_insert = created and not skip_build_tree
+
+        if not skip_build_tree and not created:
+            self.path = get_tree_backend().build_path(self.parent.path if self.parent else None, self.pk)
+
+        if not self.is_removed:
+            self.removed_at = None
+        elif self.removed_at is None:
+            self.removed_at = timezone.now()
+
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
 
-        if skip_build_tree:
-            return None
+        with transaction.atomic(using=using):
+            old = None
 
-        tree_path = []
+            if not created:
+                # row is locked, so concurrent saves count the flip of "is_removed" once...
+                old = type(self)._default_manager.using(using).select_for_update().filter(pk=self.pk).values_list(
+                    'content_type_id', 'object_id', 'is_removed'
+                ).first()
 
-        if self.parent:
-            tree_path.extend(self.parent.path)
+            super(Comment, self).save(*args, **kwargs)
+
+            if old is None or old[:2] != (self.content_type_id, self.object_id):
+                if old is not None:
+                    # comment is moved to another object...
+                    CommentCounter.objects.change(old[0], old[1], total=-1, not_removed=0 if old[2] else -1)
+
+                CommentCounter.objects.change(
+                    self.content_type_id,
+                    self.object_id,
+                    total=1,
+                    not_removed=0 if self.is_removed else 1
+                )
+            elif old[2] != self.is_removed:
+                CommentCounter.objects.change(self.content_type_id, self.object_id, not_removed=1 if old[2] else -1)
+
+            bump_comments_version(self.content_type_id, self.object_id, using=kwargs.get('using'))
+
+    def _do_insert(self, manager, using, fields, update_pk, raw):
+        """
+        Insert comment and compute its "path" from the path of parent in one statement.
+
+        """
+        if raw or not update_pk or not getattr(self, '_build_tree_on_insert', False):
+            return super(Comment, self)._do_insert(manager, using, fields, update_pk, raw)
+
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        opts = self._meta
+
+        path_field = opts.get_field('path')
+        fields = [field for field in fields if field is not path_field]
+        values = [field.get_db_prep_save(field.pre_save(self, True), connection=connection) for field in fields]
+
+        parent_path = 'COALESCE(parent.{path}, ARRAY[]::integer[])'
+        max_length = get_tree_backend().max_length
+
+        if max_length is not None:
+            parent_path = (
+                'CASE WHEN array_length(parent.{{path}}, 1) >= {max_length} '
+                'THEN parent.{{path}}[1:{last}] ELSE {parent_path} END'
+            ).format(max_length=max_length, last=max_length - 1, parent_path=parent_path)
+
+        sql = (
+            'WITH new_comment AS (SELECT nextval(pg_get_serial_sequence(%s, %s))::integer AS {pk}) '
+            'INSERT INTO {table} ({pk}, {columns}, {path}) VALUES ('
+            '(SELECT {pk} FROM new_comment), {placeholders}, '
+            '(SELECT ' + parent_path + ' || new_comment.{pk} FROM new_comment LEFT JOIN {table} parent ON parent.{pk} = %s)'
+            ') RETURNING {pk}, {path}'
+        ).format(
+            table=qn(opts.db_table),
+            pk=qn(opts.pk.column),
+            path=qn(path_field.column),
+            columns=', '.join(qn(field.column) for field in fields),
+            placeholders=', '.join(['%s'] * len(fields))
+        )
 
-        if MAX_LENGTH_OF_COMMENT_TREE is None or len(tree_path) < MAX_LENGTH_OF_COMMENT_TREE:
-            tree_path.append(self.id)
-        else:
-            tree_path[-1] = self.id
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [opts.db_table, opts.pk.column] + values + [self.parent_id])
+            pk, self.path = cursor.fetchone()
 
-        Comment.objects.filter(pk=self.pk).update(path=tree_path)
+        return pk
 
     def __str__(self):
         return '<Comment: id {0}, user {1}, model {2}, object_id {3}>'.format(
             self.id,
             self.user.username,
-            self.content_type,
+            ContentType.objects.get_for_id(self.content_type_id),
             self.object_id
         )
 
@@ -92,3 +183,148 @@ class Comment(models.Model):
             ('remove_comment', _('Can remove comment')),
             ('remove_comment_tree', _('Can remove comment tree')),
         )
+
+
+class ArchivedComment(models.Model):
+    """
+    Comment moved out of "comments_comment" table together with its whole root thread
+    (see CommentManager.archive_threads and "archive_comments" command), ids are kept.
+    Archived threads are read-only: they are rendered by render_comment_list and CommentPage
+    if COMMENTS_INCLUDE_ARCHIVED is set and their replies are loaded by CommentSubtree.
+    CommentTreeJSON, CommentSync, removal of comments and admin search ("search_vector"
+    is not kept) cover comments table only.
+
+    """
+
+    id = models.IntegerField(primary_key=True, verbose_name=_('ID'))
+    user = models.ForeignKey(AUTH_USER_MODEL, related_name='+', verbose_name=_('User'))
+    content_type = models.ForeignKey(ContentType, related_name='+', verbose_name=_('Content type'))
+    object_id = models.PositiveIntegerField(verbose_name=_('Object ID'))
+    comment = models.TextField(verbose_name=_('Comment'))
+    pub_date = models.DateTimeField(verbose_name=_('Date'))
+    is_removed = models.BooleanField(verbose_name=_('Is removed'), default=False)
+    removed_at = models.DateTimeField(verbose_name=_('Removal date'), null=True, blank=True)
+    path = ArrayField(models.PositiveIntegerField(), null=True)
+    parent = models.ForeignKey('self', verbose_name=_('Parent'), related_name='+', null=True, blank=True)
+    archived_at = models.DateTimeField(verbose_name=_('Archival date'), auto_now_add=True)
+
+    objects = CommentQuerySet.as_manager()
+
+    @property
+    def depth(self):
+        return min(len(self.path), COMMENTS_MAX_DEPTH)
+
+    @property
+    def root_id(self):
+        return self.path[0]
+
+    def __str__(self):
+        return '<ArchivedComment: id {0}, model {1}, object_id {2}>'.format(
+            self.id,
+            ContentType.objects.get_for_id(self.content_type_id),
+            self.object_id
+        )
+
+    class Meta:
+        ordering = ('path',)
+        db_table = 'comments_archived_comment'
+        verbose_name = _('Archived comment')
+        verbose_name_plural = _('Archived comments')
+
+
+class CommentRowUser(object):
+    """
+    Author of CommentRow (only username is selected).
+
+    """
+
+    __slots__ = ('id', 'username')
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    def __str__(self):
+        return self.username
+
+
+class CommentRow(object):
+    """
+    Read-only comment of comment list (see CommentQuerySet.rows and COMMENTS_ROW_MODE),
+    has columns used by comment templates, "depth" and "root_id" like Comment and
+    attributes set by annotate_comment_tree and collapse_comment_tree.
+
+    """
+
+    __slots__ = (
+        'id', 'parent_id', 'content_type_id', 'object_id', 'path', 'user', 'pub_date', 'comment', 'is_removed',
+        'open', 'close', 'hidden_replies'
+    )
+
+    # selected by values_list, order of arguments of __init__...
+    fields = (
+        'id', 'parent_id', 'content_type_id', 'object_id', 'path', 'user_id', 'user__username', 'pub_date',
+        'comment', 'is_removed'
+    )
+
+    def __init__(self, id, parent_id, content_type_id, object_id, path, user_id, username, pub_date, comment,
+                 is_removed):
+        self.id = id
+        self.parent_id = parent_id
+        self.content_type_id = content_type_id
+        self.object_id = object_id
+        self.path = path
+        self.user = CommentRowUser(user_id, username)
+        self.pub_date = pub_date
+        self.comment = comment
+        self.is_removed = is_removed
+        self.open = False
+        self.close = ()
+        self.hidden_replies = 0
+
+    @property
+    def pk(self):
+        return self.id
+
+    @property
+    def user_id(self):
+        return self.user.id
+
+    @property
+    def depth(self):
+        return min(len(self.path), COMMENTS_MAX_DEPTH)
+
+    @property
+    def root_id(self):
+        return self.path[0]
+
+    def __repr__(self):
+        return '<CommentRow: id {0}>'.format(self.id)
+
+
+class CommentCounter(models.Model):
+    """
+    Denormalized count of comments of object, kept in sync by Comment.save and
+    CommentManager.mark_removed (rebuild with "rebuild_comment_counters" command).
+
+    """
+
+    content_type = models.ForeignKey(ContentType, verbose_name=_('Content type'))
+    object_id = models.PositiveIntegerField(verbose_name=_('Object ID'))
+    total = models.PositiveIntegerField(verbose_name=_('Total'), default=0)
+    not_removed = models.PositiveIntegerField(verbose_name=_('Not removed'), default=0)
+
+    objects = CommentCounterManager()
+
+    def __str__(self):
+        return '<CommentCounter: model {0}, object_id {1}, total {2}>'.format(
+            self.content_type,
+            self.object_id,
+            self.total
+        )
+
+    class Meta:
+        db_table = 'comments_comment_counter'
+        unique_together = ('content_type', 'object_id')
+        verbose_name = _('Comment counter')
+        verbose_name_plural = _('Comment counters')
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.template.defaultfilters import date
+from django.utils.encoding import force_text
+from django.utils.formats import localize
+from django.utils.html import conditional_escape
+from django.utils.module_loading import import_string
+from django.utils.safestring import mark_safe
+from django.utils.timezone import template_localtime
+
+from comments.utils import annotate_comment_tree
+
+
+# function rendering comment list instead of "comments/render_comment_page.html" template,
+# called with comments and template context (e.g. "comments.renderers.render_comment_page")...
+
+RENDER_COMMENT_PAGE_FUNCTION = getattr(settings, 'RENDER_COMMENT_PAGE_FUNCTION', None)
+
+
+def get_comment_page_renderer():
+    if RENDER_COMMENT_PAGE_FUNCTION is None:
+        return None
+
+    return import_string(RENDER_COMMENT_PAGE_FUNCTION)
+
+
+def _has_perm(perms, name):
+    if not perms:
+        return False
+
+    return bool(perms['comments'][name])
+
+
+def render_comment_page(comments, context):
+    """
+    Render comments (ordered by "path") to the same HTML as "comments/render_comment_page.html"
+    template, URLs and permissions are resolved once instead of once per comment.
+    ``context`` - template context (its "perms", autoescape and localization are used).
+
+    """
+    autoescape = getattr(context, 'autoescape', True)
+    use_l10n = getattr(context, 'use_l10n', None)
+    use_tz = getattr(context, 'use_tz', None)
+    perms = context.get('perms')
+
+    def value(obj):
+        obj = force_text(localize(template_localtime(obj, use_tz), use_l10n))
+        return conditional_escape(obj) if autoescape else obj
+
+    def url(name):
+        return value(reverse(name))
+
+    remove_tree_button = ''
+    remove_button = ''
+
+    if _has_perm(perms, 'remove_comment_tree'):
+        remove_tree_button = (
+            '\n                        <button type="button" action="{0}" class="remove_comment_tree btn btn-link">'
+            'Удалить дерево комментариев</button>\n                    '
+        ).format(url('remove_comment_tree'))
+
+    if _has_perm(perms, 'remove_comment'):
+        remove_button = (
+            '\n                        <button type="button" action="{0}" class="remove_comment btn btn-link">'
+            'Удалить коментарий</button>\n                    '
+        ).format(url('remove_comment'))
+
+    load_replies_url = None
+    chunks = ['\n\n']
+
+    for comment in annotate_comment_tree(comments):
+        chunks.append('\n    \n        <ul>\n    ' if getattr(comment, 'open', False) else '\n    \n        </li>\n    ')
+        chunks.append(
+            '\n    <li class="comment_li" id="{0}" depth="{1}">\n        <div class="comment_data">\n            '.format(
+                value(comment.id),
+                value(comment.depth)
+            )
+        )
+
+        if not comment.is_removed:
+            chunks.append(
+                '\n                <div class="comment_info">'
+                '\n                    <p class="comment_user">{0}</p>'
+                '\n                    <p class="comment_data">Дата: {1}</p>'
+                '\n                    {2}\n                    {3}'
+                '\n                    <button type="button" class="comment_reply btn btn-link">Ответить</button>'
+                '\n                </div>'
+                '\n                <div class="comment_text">'
+                '\n                    {4}'
+                '\n                </div>'
+                '\n                <div class="reply_form_position"></div>'
+                '\n            '.format(
+                    value(comment.user.username),
+                    value(date(template_localtime(comment.pub_date, use_tz), 'd.m.Y, H:i')),
+                    remove_tree_button,
+                    remove_button,
+                    value(comment.comment)
+                )
+            )
+        else:
+            chunks.append('\n                <p>Злые марсиане похитили комментарий.</p>\n            ')
+
+        chunks.append('\n        </div>\n        ')
+
+        hidden_replies = getattr(comment, 'hidden_replies', 0)
+
+        if hidden_replies:
+            if load_replies_url is None:
+                load_replies_url = url('comment_subtree')
+
+            chunks.append(
+                '\n            <button type="button" action="{0}" class="load_replies btn btn-link">'
+                'Показать ответы ({1})</button>\n        '.format(load_replies_url, value(hidden_replies))
+            )
+
+        chunks.append('\n    ')
+        chunks.append('\n    </li></ul>\n    ' * len(getattr(comment, 'close', ())))
+        chunks.append('\n')
+
+    return mark_safe(''.join(chunks))
@@ -0,0 +1,129 @@
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+# database aliases of replicas used for reads of comments (empty - all reads go to primary)...
+
+COMMENTS_REPLICAS = getattr(settings, 'COMMENTS_REPLICAS', [])
+
+# seconds during which reads of user go to primary after write of the user (longer than replication lag)...
+
+COMMENTS_PIN_SECONDS = getattr(settings, 'COMMENTS_PIN_SECONDS', 10)
+
+COMMENTS_PIN_COOKIE = getattr(settings, 'COMMENTS_PIN_COOKIE', 'comments_pin')
+
+
+_state = threading.local()
+
+
+def pin_to_primary():
+    """
+    Send reads of current thread (request) to primary and pin reads of user to primary
+    for COMMENTS_PIN_SECONDS (see ReplicaPinningMiddleware).
+
+    """
+    _state.pinned = True
+    _state.wrote = True
+
+
+def is_pinned():
+    return getattr(_state, 'pinned', False)
+
+
+@contextmanager
+def use_primary():
+    """
+    Send reads of current thread to primary inside of the block (e.g. in management
+    commands and tasks, which are not reset by requests).
+
+    """
+    pinned = is_pinned()
+    _state.pinned = True
+
+    try:
+        yield
+    finally:
+        _state.pinned = pinned
+
+
+def reset_pinning(**kwargs):
+    """
+    Unpin thread at start and end of every request, so thread is not left pinned
+    if ReplicaPinningMiddleware is not installed.
+
+    """
+    _state.pinned = False
+    _state.wrote = False
+
+
+request_started.connect(reset_pinning)
+request_finished.connect(reset_pinning)
+
+
+class CommentRouter(object):
+    """
+    Send reads of comments app models to random replica of COMMENTS_REPLICAS unless
+    they are pinned to primary (by write of user) or made inside of transaction,
+    writes go to primary. Counters are always read from primary, they are rebuilt
+    from what is read and lagged replica would write stale counts.
+
+    """
+
+    app_label = 'comments'
+    primary_models = ('commentcounter',)
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != self.app_label or not COMMENTS_REPLICAS:
+            return None
+
+        if model._meta.model_name in self.primary_models:
+            return DEFAULT_DB_ALIAS
+
+        if is_pinned() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+
+        return random.choice(COMMENTS_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != self.app_label:
+            return None
+
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = [DEFAULT_DB_ALIAS] + list(COMMENTS_REPLICAS)
+
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in COMMENTS_REPLICAS:
+            return False
+
+        return None
+
+
+class ReplicaPinningMiddleware(object):
+    """
+    Pin reads of request to primary if user wrote comments recently (cookie is set
+    by response of request which called pin_to_primary).
+
+    """
+
+    def process_request(self, request):
+        _state.pinned = COMMENTS_PIN_COOKIE in request.COOKIES
+        _state.wrote = False
+
+    def process_response(self, request, response):
+        if getattr(_state, 'wrote', False):
+            response.set_cookie(COMMENTS_PIN_COOKIE, '1', max_age=COMMENTS_PIN_SECONDS, httponly=True)
+            _state.wrote = False
+
+        return response
@@ -36,8 +36,7 @@ $(document).ready(function() {
 
         var on_success = function(data, status) {
             if (data.success) {
-                var comment = $('#comments').find('#' + data.comment_id);
-                comment.find('> .comment_data').replaceWith(data.comment);
+                replaceRemovedComment(data);
             }
         };
 
@@ -57,29 +56,122 @@ $(document).ready(function() {
 
         var on_success = function(data, status) {
             if (data.success) {
-                var parent = $('#comments').find('#' + data.parent_id);
-                var replace_data = $(data.replace_data).children().unwrap();
-                var temp = parent.next();
+                replaceRemovedCommentTree(data);
+            }
+        };
 
-                while (temp.length) {
-                    var id = parseInt(temp.attr('id'))
+        ajaxQueryComment(data, query_url, on_success);
+        event.preventDefault();
+    });
 
-                    if (data.list_id.indexOf(id) > 0) {
-                        temp.remove();
-                        temp = parent.next();
-                    }
-                    else {
-                        temp = temp.next()
-                    }
+    $('#comments').on('click', '.load_more_comments', function(event) {
+        var button = $(this);
+        var data = {
+            object_id: button.attr('object_id'),
+            after: button.attr('after')
+        };
+
+        var on_success = function(data, status) {
+            if (data.success) {
+                button.before(data.comment_list);
+
+                if (data.next_after) {
+                    button.attr('after', data.next_after);
+                }
+                else {
+                    button.remove();
                 }
-                parent.replaceWith(replace_data);
             }
         };
 
-        ajaxQueryComment(data, query_url, on_success);
+        $.ajax({
+            url: button.attr('action'),
+            type: 'GET',
+            dataType: 'json',
+            data: data,
+            success: on_success
+        });
+
         event.preventDefault();
     });
 
+    $('#comments').on('click', '.load_replies', function(event) {
+        var button = $(this);
+        var comment = button.closest('.comment_li');
+
+        var on_success = function(data, status) {
+            if (data.success) {
+                var comment_section = $('#comments');
+
+                $.each(data.comments, function(index, reply) {
+                    if (!comment_section.find('#' + reply.id).length) {
+                        var parent_comment = comment_section.find('#' + reply.parent);
+                        getUlForAppendComment(parent_comment).append(reply.comment);
+                    }
+                });
+
+                button.remove();
+            }
+        };
+
+        $.ajax({
+            url: button.attr('action'),
+            type: 'GET',
+            dataType: 'json',
+            data: {comment_id: comment.attr('id')},
+            success: on_success
+        });
+
+        event.preventDefault();
+    });
+
+    var events_url = $('#comments').attr('events');
+
+    if (events_url && window.EventSource) {
+        var events = new EventSource(events_url);
+
+        events.addEventListener('add', function(event) {
+            postComment(JSON.parse(event.data));
+        });
+
+        events.addEventListener('remove', function(event) {
+            replaceRemovedComment(JSON.parse(event.data));
+        });
+
+        events.addEventListener('remove_tree', function(event) {
+            replaceRemovedCommentTree(JSON.parse(event.data));
+        });
+    }
+
+    function replaceRemovedComment(data) {
+        var comment = $('#comments').find('#' + data.comment_id);
+        comment.find('> .comment_data').replaceWith(data.comment);
+    }
+
+    function replaceRemovedCommentTree(data) {
+        var parent = $('#comments').find('#' + data.parent_id);
+
+        if (!parent.length || !data.replace_data) {
+            return;
+        }
+
+        var replace_data = $(data.replace_data).children().unwrap();
+        var temp = parent.next();
+
+        while (temp.length) {
+            var id = parseInt(temp.attr('id'))
+
+            if (data.list_id.indexOf(id) > 0) {
+                temp.remove();
+                temp = parent.next();
+            }
+            else {
+                temp = temp.next()
+            }
+        }
+        parent.replaceWith(replace_data);
+    }
+
     function ajaxQueryComment(data, query_url, on_success) {
         $.ajax({
             url: query_url,
@@ -94,6 +186,11 @@ $(document).ready(function() {
         var comment_section = $('#comments');
         var comments_count = $('.comments_count');
 
+        // comment may be already added by event of "comment_events" view...
+        if (!data.comment || comment_section.find('#' + data.id).length) {
+            return;
+        }
+
         if (data.parent) {
             var parent_comment = comment_section.find('#' + data.parent);
             var ul_for_append = getUlForAppendComment(parent_comment);
@@ -3,10 +3,21 @@ from django import template
 from django.contrib.contenttypes.models import ContentType
 from django.template.loader import render_to_string
 from django.template import RequestContext
+from django.db.models.query import QuerySet
 
+from comments import broker, cache, metrics
+from comments.renderers import get_comment_page_renderer
+from comments.routers import use_primary
 from comments.models import Comment
-from comments.utils import annotate_comment_tree
-from comments.models import COMMENTS_MAX_DEPTH
+from comments.utils import annotate_comment_tree, collapse_comment_tree
+from comments.models import (
+    COMMENTS_COLLAPSE_DEPTH,
+    COMMENTS_INCLUDE_ARCHIVED,
+    COMMENTS_MAX_DEPTH,
+    COMMENTS_MAX_REPLIES,
+    COMMENTS_ROW_MODE,
+    COMMENTS_THREADS_PER_PAGE
+)
 
 
 register = template.Library()
@@ -16,6 +27,8 @@ RENDER_COMMENT_TREE = getattr(settings, 'RENDER_COMMENT_TREE', 'comments/render_
 
 
 class BaseCommentNode(template.Node):
+    tag_name = None
+
     def __init__(self, obj=None, obj_id=None, as_varname=None):
         self.obj = template.Variable(obj)
         self.as_varname = as_varname
@@ -35,14 +48,23 @@ class BaseCommentNode(template.Node):
         template.TemplateSyntaxError('Tag {0} takes 5 arguments.'.format(tokens[0]))
 
     def render(self, context):
-        qs = self.get_queryset(context)
-        context[self.as_varname] = self.get_context_value_from_queryset(qs)
+        with metrics.timer('comments.query', tag=self.tag_name) as timer:
+            qs = self.get_queryset(context)
+            context[self.as_varname] = self.get_context_value_from_queryset(qs)
+            timer.set(rows=len(context[self.as_varname]))
+
         return ''
 
     def get_queryset(self, context):
         ctype, object_id = self.get_ctype_and_pk(context)
         if object_id:
-            return Comment.objects.filter(content_type=ctype, object_id=object_id)
+            qs = Comment.objects.filter(content_type=ctype, object_id=object_id).for_tree()
+
+            if COMMENTS_INCLUDE_ARCHIVED:
+                # list of comments and archived comments ordered by path...
+                return Comment.objects.with_archived(qs, ctype, object_id, rows=COMMENTS_ROW_MODE)
+
+            return qs
 
         return Comment.objects.none()
 
@@ -61,10 +83,18 @@ class BaseCommentNode(template.Node):
 class CommentListNode(BaseCommentNode):
     """
     Insert a list of comments into the context.
+    Usage: {% get_comment_list for <object> as <varname> %}
+
+    If COMMENTS_ROW_MODE is set, the list consists of read-only CommentRow.
 
     """
 
+    tag_name = 'get_comment_list'
+
     def get_context_value_from_queryset(self, qs):
+        if COMMENTS_ROW_MODE and isinstance(qs, QuerySet):
+            return qs.rows()
+
         return list(qs)
 
 
@@ -73,8 +103,23 @@ class RenderCommentListNode(CommentListNode):
     Render comment list for object.
     Usage: {% render_comment_list for <object> %}
 
+    If COMMENTS_THREADS_PER_PAGE is set, only first page of root threads is rendered,
+    next pages are loaded by "comment_page" view.
+    If COMMENTS_MAX_REPLIES or COMMENTS_COLLAPSE_DEEP_REPLIES is set, hidden replies are
+    loaded by "comment_subtree" view.
+    If COMMENTS_INCLUDE_ARCHIVED is set, archived threads are rendered too (and paged by "comment_page" view).
+    If COMMENTS_CACHE is set, rendered list is cached until comments of object are changed.
+    If COMMENTS_TREE_LRU_SIZE is set, fetched comment list is kept in memory of process
+    until comments of object are changed (rendered for every user, COMMENTS_VERSION_CACHE
+    must be shared by processes, see comments.cache).
+    If RENDER_COMMENT_PAGE_FUNCTION is set, comments are rendered by it instead of template
+    (see comments.renderers).
+    If COMMENTS_LIVE_EVENTS is set, rendered list is updated by "comment_events" view.
+
     """
 
+    tag_name = 'render_comment_list'
+
     @classmethod
     def handle_token(cls, parser, token):
         tokens = token.split_contents()
@@ -87,16 +132,88 @@ class RenderCommentListNode(CommentListNode):
 
         template.TemplateSyntaxError('Tag {0} takes 3 arguments.'.format(tokens[0]))
 
+    def get_tree(self, context, ctype, object_id):
+        """
+        Return context variables of comment tree of object: fetched and collapsed comment list,
+        comments count and cursor of the next page (if COMMENTS_THREADS_PER_PAGE is set).
+
+        """
+        tree = {}
+
+        with metrics.timer('comments.query', tag=self.tag_name) as timer:
+            if COMMENTS_THREADS_PER_PAGE is None:
+                qs = self.get_queryset(context)
+                comment_list = self.get_context_value_from_queryset(qs)
+                tree['comments_count'] = len(comment_list)
+            else:
+                qs, next_after = Comment.objects.thread_page(
+                    ctype,
+                    object_id,
+                    COMMENTS_THREADS_PER_PAGE,
+                    archived=COMMENTS_INCLUDE_ARCHIVED,
+                    rows=COMMENTS_ROW_MODE
+                )
+                comment_list = self.get_context_value_from_queryset(qs)
+                tree['comments_count'] = Comment.objects.comments_count(ctype, object_id)
+                tree['comment_page'] = {'object_id': object_id, 'next_after': next_after}
+
+            timer.set(rows=len(comment_list))
+
+        with metrics.timer('comments.collapse', tag=self.tag_name):
+            tree['comment_list'] = collapse_comment_tree(
+                comment_list,
+                COMMENTS_MAX_REPLIES,
+                COMMENTS_COLLAPSE_DEPTH
+            )
+
+        return tree
+
     def render(self, context):
         ctype, object_id = self.get_ctype_and_pk(context)
         if object_id:
-            qs = self.get_queryset(context)
-            context['comment_list'] = self.get_context_value_from_queryset(qs)
+            cache_key = cache.tree_cache_key(ctype.pk, object_id, context.get('user'))
 
-            rendered_comment_list = render_to_string(
-                RENDER_COMMENT_TREE,
-                context
-            )
+            if cache_key is not None:
+                rendered_comment_list = cache.get_fragment(cache_key)
+                metrics.emit('comments.cache', tag=self.tag_name, hit=rendered_comment_list is not None)
+
+                if rendered_comment_list is not None:
+                    return rendered_comment_list
+
+            tree, version = cache.get_tree(ctype.pk, object_id)
+
+            if version is not None:
+                metrics.emit('comments.tree_cache', tag=self.tag_name, hit=tree is not None)
+
+            if tree is None:
+                if cache_key is None and version is None:
+                    tree = self.get_tree(context, ctype, object_id)
+                else:
+                    # replica may lag behind bump of version, so cached tree is read from primary...
+                    with use_primary():
+                        tree = self.get_tree(context, ctype, object_id)
+
+                cache.set_tree(ctype.pk, object_id, tree, version)
+
+            for key, value in tree.items():
+                context[key] = value
+
+            if broker.COMMENTS_LIVE_EVENTS:
+                context['comment_events'] = {'object_id': object_id}
+
+            with metrics.timer('comments.render', tag=self.tag_name):
+                render_comment_page = get_comment_page_renderer()
+
+                if render_comment_page is not None:
+                    context['comment_page_html'] = render_comment_page(context['comment_list'], context)
+
+                rendered_comment_list = render_to_string(
+                    RENDER_COMMENT_TREE,
+                    context
+                )
+
+            if cache_key is not None:
+                cache.set_fragment(cache_key, rendered_comment_list)
 
             return rendered_comment_list
         else:
@@ -115,8 +232,44 @@ def render_comment_list(parser, token):
 
 @register.simple_tag
 def comments_count(obj):
-    content_type = ContentType.objects.get_for_model(obj)
-    return Comment.objects.filter(content_type=content_type, object_id=obj.id).count()
+    count = getattr(obj, 'comments_count', None)
+
+    # count attached by "with_comments_count" filter...
+    if isinstance(count, int):
+        return count
+
+    with metrics.timer('comments.count', tag='comments_count'):
+        content_type = ContentType.objects.get_for_model(obj)
+        return Comment.objects.comments_count(content_type, obj.pk)
+
+
+@register.filter
+def with_comments_count(objects):
+    """
+    Attach count of comments to every object in one query per model.
+    Usage: {% for obj in objects|with_comments_count %}{% comments_count obj %}{% endfor %}
+
+    """
+    with metrics.timer('comments.count', tag='with_comments_count') as timer:
+        objects = Comment.objects.prefetch_comments_count(objects)
+        timer.set(rows=len(objects))
+
+    return objects
+
+
+@register.simple_tag
+def prefetch_top_comments(objects, limit=3, replies=0):
+    """
+    Attach the latest comments to every object as "top_comments" list by one query.
+    Usage: {% prefetch_top_comments objects limit=3 replies=1 as objects %}
+    {% for obj in objects %}{% for comment in obj.top_comments %}...{% endfor %}{% endfor %}
+
+    """
+    with metrics.timer('comments.query', tag='prefetch_top_comments') as timer:
+        objects = Comment.objects.prefetch_top_comments(objects, limit, replies)
+        timer.set(rows=len(objects))
+
+    return objects
 
 
 @register.simple_tag
@@ -126,4 +279,12 @@ def comment_max_depth():
 
 @register.filter
 def annotate_tree(comments):
-    return annotate_comment_tree(comments)
+    if not metrics.enabled():
+        # comments are annotated lazily while they are rendered...
+        return annotate_comment_tree(comments)
+
+    with metrics.timer('comments.annotate', tag='annotate_tree') as timer:
+        comments = list(annotate_comment_tree(comments))
+        timer.set(rows=len(comments))
+
+    return comments
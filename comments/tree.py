@@ -0,0 +1,202 @@
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+
+from comments.utils import build_tree_path
+
+
+# encoding of comment tree in database ("path" column), see ArrayTreeBackend and LtreeTreeBackend...
+
+COMMENTS_TREE_BACKEND = getattr(settings, 'COMMENTS_TREE_BACKEND', 'comments.tree.ArrayTreeBackend')
+
+# maximum length of "path" array (in database), used by ArrayTreeBackend only...
+
+MAX_LENGTH_OF_COMMENT_TREE = getattr(settings, 'MAX_LENGTH_OF_COMMENT_TREE', None)
+
+
+# schema of LtreeTreeBackend, ids are zero padded, so labels are ordered as numbers...
+
+LTREE_INSTALL_SQL = [
+    'CREATE EXTENSION IF NOT EXISTS ltree',
+    'ALTER TABLE comments_comment ADD COLUMN tree_path ltree',
+    '''
+    CREATE FUNCTION comments_comment_tree_path() RETURNS trigger AS $$
+    BEGIN
+        NEW.tree_path = array_to_string(ARRAY(
+            SELECT lpad(label.id::text, 10, '0')
+            FROM unnest(NEW.path) WITH ORDINALITY AS label(id, position)
+            ORDER BY label.position
+        ), '.')::ltree;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    ''',
+    'CREATE TRIGGER comments_comment_tree_path BEFORE INSERT OR UPDATE OF path ON comments_comment '
+    'FOR EACH ROW EXECUTE PROCEDURE comments_comment_tree_path()',
+]
+
+LTREE_UNINSTALL_SQL = [
+    'DROP INDEX IF EXISTS comments_comment_tree_path',
+    'DROP TRIGGER IF EXISTS comments_comment_tree_path ON comments_comment',
+    'DROP FUNCTION IF EXISTS comments_comment_tree_path()',
+    'ALTER TABLE comments_comment DROP COLUMN IF EXISTS tree_path',
+]
+
+
+class BaseTreeBackend(object):
+    """
+    Encoding of comment tree. "path" of comment (list of ids of ancestors and comment)
+    is kept by every backend, backend decides how subtrees are selected.
+
+    """
+
+    max_length = None
+
+    def build_path(self, parent_path, comment_id):
+        return build_tree_path(parent_path, comment_id, self.max_length)
+
+    def subtree(self, queryset, comment):
+        """
+        Filter ``queryset`` of comments by subtree of ``comment`` (comment included).
+
+        """
+        raise NotImplementedError
+
+    def subtree_sql(self, comment):
+        """
+        Return (sql, params) - condition selecting subtree of ``comment`` (comment included)
+        from comments table.
+
+        """
+        raise NotImplementedError
+
+
+class ArrayTreeBackend(BaseTreeBackend):
+    """
+    Subtree is the range of "path" int[] values between path of comment and path of its
+    next sibling (arrays are compared element by element), the range is read from
+    "comments_comment_tree" index. Subtrees of comments whose paths are truncated
+    by MAX_LENGTH_OF_COMMENT_TREE are not complete.
+
+    """
+
+    max_length = MAX_LENGTH_OF_COMMENT_TREE
+
+    def path_range(self, path):
+        return list(path), list(path[:-1]) + [path[-1] + 1]
+
+    def subtree(self, queryset, comment):
+        start, end = self.path_range(comment.path)
+
+        return queryset.filter(
+            content_type_id=comment.content_type_id,
+            object_id=comment.object_id,
+            path__gte=start,
+            path__lt=end
+        )
+
+    def subtree_sql(self, comment):
+        start, end = self.path_range(comment.path)
+
+        return (
+            'content_type_id = %s AND object_id = %s AND path >= %s::integer[] AND path < %s::integer[]',
+            [comment.content_type_id, comment.object_id, start, end]
+        )
+
+
+class LtreeTreeBackend(BaseTreeBackend):
+    """
+    Subtree is selected by "tree_path" ltree column (zero padded ids, so labels are
+    ordered as numbers) with "<@" operator and "comments_comment_tree_path" GiST index.
+    The column is kept in sync with "path" by trigger and paths are not truncated.
+    The column is created by migration 0007 if this backend is set, or by "ltree_comments"
+    command when the backend is switched later (see install).
+
+    """
+
+    label_length = 10
+
+    def is_installed(self, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT 1 FROM information_schema.columns '
+                'WHERE table_name = %s AND column_name = %s AND table_schema = current_schema()',
+                ['comments_comment', 'tree_path']
+            )
+            return cursor.fetchone() is not None
+
+    def install(self, connection, batch_size=10000, concurrently=True):
+        """
+        Create ltree extension, "tree_path" column and trigger filling it, then fill it for
+        existing comments by ``batch_size`` comments per transaction (table is not locked
+        for the whole backfill) and build the index (concurrently if ``concurrently`` is set,
+        so it must not be called in transaction then). Return number of filled comments.
+
+        """
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                for sql in LTREE_INSTALL_SQL:
+                    cursor.execute(sql)
+
+        filled = 0
+        after = 0
+
+        while True:
+            # trigger fills "tree_path" when "path" is updated...
+            with transaction.atomic(using=connection.alias):
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'UPDATE comments_comment AS comment SET path = comment.path '
+                        'FROM (SELECT id FROM comments_comment WHERE id > %s ORDER BY id LIMIT %s) AS batch '
+                        'WHERE comment.id = batch.id RETURNING comment.id',
+                        [after, batch_size]
+                    )
+                    ids = [row[0] for row in cursor.fetchall()]
+
+            if not ids:
+                break
+
+            filled += len(ids)
+            after = max(ids)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE INDEX {0}comments_comment_tree_path ON comments_comment USING gist (tree_path)'.format(
+                    'CONCURRENTLY ' if concurrently else ''
+                )
+            )
+
+        return filled
+
+    def uninstall(self, connection):
+        """
+        Drop "tree_path" column, its trigger and index (ltree extension is kept).
+
+        """
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                for sql in LTREE_UNINSTALL_SQL:
+                    cursor.execute(sql)
+
+    def encode(self, path):
+        return '.'.join(str(comment_id).zfill(self.label_length) for comment_id in path)
+
+    def subtree(self, queryset, comment):
+        table = connections[queryset.db].ops.quote_name(queryset.model._meta.db_table)
+
+        return queryset.extra(where=['{0}.tree_path <@ %s::ltree'.format(table)], params=[self.encode(comment.path)])
+
+    def subtree_sql(self, comment):
+        return 'tree_path <@ %s::ltree', [self.encode(comment.path)]
+
+
+_backend = None
+
+
+def get_tree_backend():
+    global _backend
+
+    if _backend is None:
+        _backend = import_string(COMMENTS_TREE_BACKEND)()
+
+    return _backend
@@ -1,3 +1,6 @@
+import json
+from array import array
+
 
 def annotate_comment_tree(comments):
     if not comments:
@@ -23,3 +26,242 @@ def annotate_comment_tree(comments):
 
     current.close = range(current.depth)
     yield current
+
+
+def collapse_comment_tree(comments, max_replies=None, max_depth=None):
+    """
+    Return comments (ordered by "path") without replies beyond the first ``max_replies``
+    replies of every comment and without comments deeper than ``max_depth``. Number of
+    hidden descendants is set as "hidden_replies" of the nearest shown comment.
+
+    """
+    if max_replies is None and max_depth is None:
+        return comments
+
+    return [comment for comment, owner in _iter_collapsed(comments, max_replies, max_depth) if owner is comment]
+
+
+def hidden_replies(comments, max_replies=None, max_depth=None):
+    """
+    Return replies which collapse_comment_tree hides behind the first of ``comments`` (comment
+    followed by its descendants ordered by "path"), replies shown with it are skipped.
+
+    """
+    comments = list(comments)
+
+    if not comments or (max_replies is None and max_depth is None):
+        return comments[1:]
+
+    root = comments[0]
+
+    return [
+        comment
+        for comment, owner in _iter_collapsed(comments, max_replies, max_depth)
+        if owner is root and comment is not root
+    ]
+
+
+def _iter_collapsed(comments, max_replies, max_depth):
+    # yield (comment, nearest shown comment - comment itself if it is shown)...
+    opened = []
+
+    for comment in comments:
+        level = len(comment.path)
+
+        while opened and opened[-1][0] >= level:
+            opened.pop()
+
+        parent = opened[-1] if opened else None
+
+        if parent is None:
+            hidden = False
+        elif parent[1] is not parent[2]:
+            hidden = True
+        elif max_depth is not None and level > max_depth:
+            hidden = True
+        else:
+            hidden = max_replies is not None and parent[3] >= max_replies
+
+        if hidden:
+            # nearest shown ancestor of comment...
+            owner = parent[2]
+            owner.hidden_replies += 1
+        else:
+            owner = comment
+            comment.hidden_replies = 0
+
+            if parent is not None:
+                parent[3] += 1
+
+        # level, comment, nearest shown comment, number of shown replies...
+        opened.append([level, comment, owner, 0])
+
+        yield comment, owner
+
+
+def build_tree_path(parent_path, comment_id, max_length=None):
+    tree_path = list(parent_path or [])
+
+    if max_length is None or len(tree_path) < max_length:
+        tree_path.append(comment_id)
+    else:
+        tree_path[-1] = comment_id
+
+    return tree_path
+
+
+def iter_comment_tree_json(comments, encoder=None):
+    """
+    Yield chunks of JSON list of nested comments (every comment has "children" list).
+    ``comments`` - iterable of dicts with "path" key ordered by "path", the tree is
+    built in one pass, so only the chain of open ancestors is kept in memory.
+
+    """
+    opened = []
+    need_comma = False
+
+    yield '['
+
+    for comment in comments:
+        level = len(comment['path'])
+
+        while opened and opened[-1] >= level:
+            opened.pop()
+            need_comma = True
+            yield ']}'
+
+        if need_comma:
+            yield ','
+
+        # replace closing brace of object with list of children...
+        yield json.dumps(comment, cls=encoder)[:-1] + ', "children": ['
+
+        opened.append(level)
+        need_comma = False
+
+    yield ']}' * len(opened)
+    yield ']'
+
+
+class CommentTree(object):
+    """
+    Comment tree built once from (id, path) rows ordered by "path". Nodes are stored in
+    parallel arrays (node is position of row), so no object is allocated per comment.
+
+    """
+
+    __slots__ = ('ids', 'levels', 'parents', 'ends', 'positions')
+
+    def __init__(self, rows):
+        self.ids = array('l')
+        self.levels = array('l')
+        self.parents = array('l')
+        self.ends = array('l')
+        self.positions = {}
+
+        opened = []
+
+        for position, (comment_id, path) in enumerate(rows):
+            level = len(path)
+
+            while opened and self.levels[opened[-1]] >= level:
+                self.ends[opened.pop()] = position - 1
+
+            self.ids.append(comment_id)
+            self.levels.append(level)
+            self.parents.append(opened[-1] if opened else -1)
+            self.ends.append(position)
+            self.positions[comment_id] = position
+
+            opened.append(position)
+
+        for position in opened:
+            self.ends[position] = len(self.ids) - 1
+
+    @classmethod
+    def from_queryset(cls, queryset):
+        return cls(queryset.values_list('id', 'path').iterator())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, comment_id):
+        return comment_id in self.positions
+
+    def roots(self):
+        return self._children(-1)
+
+    def children(self, comment_id):
+        return self._children(self.positions[comment_id])
+
+    def _children(self, position):
+        children = []
+        child = position + 1
+        end = self.ends[position] if position >= 0 else len(self.ids) - 1
+
+        while child <= end:
+            children.append(self.ids[child])
+            child = self.ends[child] + 1
+
+        return children
+
+    def ancestors(self, comment_id):
+        """
+        Return ids of ancestors of comment from parent to root.
+
+        """
+        ancestors = []
+        position = self.parents[self.positions[comment_id]]
+
+        while position >= 0:
+            ancestors.append(self.ids[position])
+            position = self.parents[position]
+
+        return ancestors
+
+    def descendants_count(self, comment_id):
+        position = self.positions[comment_id]
+        return self.ends[position] - position
+
+    def subtree_size(self, comment_id):
+        return self.descendants_count(comment_id) + 1
+
+    def subtree(self, comment_id):
+        position = self.positions[comment_id]
+        return self.ids[position:self.ends[position] + 1].tolist()
+
+    def annotate(self, max_depth=None):
+        """
+        Yield (id, depth, open, close) for every comment, where ``open`` and ``close``
+        mean the same as "open" and len("close") set by annotate_comment_tree.
+
+        """
+        count = len(self.ids)
+
+        for position in range(count):
+            depth = self.levels[position] if max_depth is None else min(self.levels[position], max_depth)
+
+            if position == 0:
+                opened = True
+            else:
+                previous_depth = self.levels[position - 1]
+
+                if max_depth is not None:
+                    previous_depth = min(previous_depth, max_depth)
+
+                opened = depth > previous_depth or self.parents[position] == -1
+
+            if position + 1 < count:
+                next_depth = self.levels[position + 1]
+
+                if max_depth is not None:
+                    next_depth = min(next_depth, max_depth)
+
+                close = max(depth - next_depth, 0)
+
+                if self.parents[position + 1] == -1:
+                    close += 1
+            else:
+                close = depth
+
+            yield self.ids[position], depth, opened, close
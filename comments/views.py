@@ -1,8 +1,10 @@
 import json
+import time
+from datetime import timedelta
 
 from django.conf import settings
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.views.generic import View
 from django.contrib.contenttypes.models import ContentType
 from django.utils.decorators import method_decorator
@@ -10,26 +12,81 @@ from django.contrib.auth.decorators import login_required
 from django.template.loader import render_to_string
 from django.utils.translation import ugettext_lazy as _
 from django.core.exceptions import ObjectDoesNotExist
-from django.template import RequestContext
-
+from django.db.models.query import QuerySet
+from django.template import Context, RequestContext
+from django.contrib.auth.context_processors import PermWrapper
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from comments import broker, metrics
+from comments.renderers import get_comment_page_renderer
+from comments.routers import pin_to_primary
 from comments.forms import CommentForm
-from comments.models import Comment
+from comments.models import (
+    ArchivedComment,
+    Comment,
+    COMMENTS_COLLAPSE_DEPTH,
+    COMMENTS_INCLUDE_ARCHIVED,
+    COMMENTS_MAX_DEPTH,
+    COMMENTS_MAX_REPLIES,
+    COMMENTS_ROW_MODE,
+    COMMENTS_THREADS_PER_PAGE
+)
+from comments.utils import collapse_comment_tree, hidden_replies, iter_comment_tree_json
 
 
 RENDER_COMMENT = getattr(settings, 'RENDER_COMMENT', 'comments/render_comment.html')
 ALERTS_COMMENT = getattr(settings, 'ALERTS_COMMENT', 'comments/alert.html')
 REMOVED_COMMENT = getattr(settings, 'REMOVED_COMMENT', 'comments/removed_comment_data.html')
 REMOVED_COMMENT_TREE = getattr(settings, 'REMOVED_COMMENT_TREE', 'comments/render_removed_comment_tree.html')
+RENDER_COMMENT_PAGE = getattr(settings, 'RENDER_COMMENT_PAGE', 'comments/render_comment_page.html')
+
+# number of root threads fetched from database at once by CommentTreeJSON...
+
+COMMENTS_JSON_CHUNK_SIZE = getattr(settings, 'COMMENTS_JSON_CHUNK_SIZE', 100)
+
+# maximum number of new comments returned by CommentSync at once...
+
+COMMENTS_SYNC_LIMIT = getattr(settings, 'COMMENTS_SYNC_LIMIT', 500)
+
+# seconds by which "since" cursor of sync goes back, so changes committed after sync but stamped
+# before it (longer transactions, clock skew) are returned by the next sync...
+
+COMMENTS_SYNC_OVERLAP = getattr(settings, 'COMMENTS_SYNC_OVERLAP', 60)
+
+JSON_COMMENT_FIELDS = ('id', 'parent_id', 'path', 'user__username', 'comment', 'pub_date', 'is_removed')
 
 ALERTS = {
     'alert_not_ajax': _('Ajax requests are only supported.'),
     'alert_not_post': _('You can add comment only using POST query.'),
-    'comment_not_exist': _('Comment with such id ({0}) does not exist.')
+    'comment_not_exist': _('Comment with such id ({0}) does not exist.'),
+    'wrong_query_parameters': _('Wrong query parameters.')
 }
 
 
-def json_error_response(error_message):
-    return HttpResponse(json.dumps({'success': False, 'error_message': error_message}))
+def json_error_response(error_message, status=200):
+    return HttpResponse(json.dumps({'success': False, 'error_message': error_message}), status=status)
+
+
+def comment_values_to_dict(values):
+    comment_id, parent_id, path, username, text, pub_date, is_removed = values
+
+    return {
+        'id': comment_id,
+        'parent': parent_id,
+        'path': path,
+        'depth': min(len(path), COMMENTS_MAX_DEPTH),
+        'root_id': path[0],
+        'user': username,
+        'comment': '' if is_removed else text,
+        'pub_date': pub_date,
+        'is_removed': is_removed
+    }
+
+
+def publish_comment_event(comment, event, data):
+    broker.publish_comment_event(comment.content_type_id, comment.object_id, event, data, using=comment._state.db)
 
 
 def render_comment(request, comment=None, template=REMOVED_COMMENT):
@@ -42,7 +99,21 @@ def render_comment(request, comment=None, template=REMOVED_COMMENT):
     return render_to_string(template, context)
 
 
-class BaseCommentView(View):
+class MetricsMixin(object):
+    """
+    Emit "comments.view" timing event for every request of view.
+
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with metrics.timer('comments.view', view=self.__class__.__name__) as timer:
+            response = super(MetricsMixin, self).dispatch(request, *args, **kwargs)
+            timer.set(status=response.status_code)
+
+        return response
+
+
+class BaseCommentView(MetricsMixin, View):
     def get(self, request, *args, **kwargs):
         if not request.is_ajax():
             return render(request, ALERTS_COMMENT, {'alert': ALERTS['alert_not_ajax']})
@@ -50,6 +121,10 @@ class BaseCommentView(View):
 
     @method_decorator(login_required)
     def dispatch(self, request, *args, **kwargs):
+        if request.method == 'POST':
+            # user must see own changes, replicas may lag...
+            pin_to_primary()
+
         return super(BaseCommentView, self).dispatch(request, *args, **kwargs)
 
     def render_alert_not_ajax(self, request):
@@ -79,14 +154,19 @@ class AddComment(BaseCommentView):
 
         if form.is_valid():
             comment = form.save()
-
-            # after form.save comment.path is None...
-            comment = Comment.objects.get(pk=comment.id)
             rendered_comment = render_comment(request, comment, RENDER_COMMENT)
 
+            # other clients get comment rendered without permissions of author...
+            publish_comment_event(comment, 'add', {
+                'id': comment.id,
+                'parent': comment.parent_id,
+                'comment': render_to_string(RENDER_COMMENT, {'comment': comment})
+            })
+
             response = json.dumps({
                 'success': True,
-                'parent': comment.parent.pk if comment.parent else None,
+                'id': comment.id,
+                'parent': comment.parent_id,
                 'comment': rendered_comment
             })
 
@@ -104,11 +184,13 @@ class RemoveComment(BaseCommentView):
         comment_id = self.request.POST.get('comment_id', None)
 
         try:
-            Comment.objects.remove_comment(comment_id)
+            comments = Comment.objects.remove_comment(comment_id)
             rendered_comment = render_comment(request)
         except (ObjectDoesNotExist, ValueError):
             return json_error_response(str(ALERTS['comment_not_exist']).format(comment_id))
 
+        publish_comment_event(comments[0], 'remove', {'comment_id': comments[0].id, 'comment': rendered_comment})
+
         return HttpResponse(json.dumps({
             'success': True,
             'message': str(_('Comment successfully removed.')),
@@ -130,10 +212,326 @@ class RemoveCommentTree(BaseCommentView):
         except (ObjectDoesNotExist, ValueError):
             return json_error_response(str(ALERTS['comment_not_exist']).format(parent_id))
 
+        list_id = [comment.id for comment in comments]
+
+        publish_comment_event(comments[0], 'remove_tree', {
+            'parent_id': comments[0].id,
+            'replace_data': replace_data,
+            'list_id': list_id
+        })
+
         return HttpResponse(json.dumps({
             'success': True,
             'message': str(_('Comments tree successfully removed.')),
             'parent_id': parent_id,
             'replace_data': replace_data,
-            'list_id': [comment.id for comment in comments]
+            'list_id': list_id
         }))
+
+
+class CommentPage(MetricsMixin, View):
+    """
+    Return next page of root threads of object (see COMMENTS_THREADS_PER_PAGE), archived
+    threads are paged too if COMMENTS_INCLUDE_ARCHIVED is set.
+    Query parameters: object_id, after (root id of last thread of previous page).
+
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not request.is_ajax():
+            return render(request, ALERTS_COMMENT, {'alert': ALERTS['alert_not_ajax']})
+
+        model = self.kwargs.get('model')
+        content_type = ContentType.objects.get_for_model(model)
+
+        try:
+            object_id = int(request.GET.get('object_id'))
+            after = int(request.GET.get('after'))
+        except (TypeError, ValueError):
+            return json_error_response(str(ALERTS['wrong_query_parameters']))
+
+        with metrics.timer('comments.query', view='CommentPage') as timer:
+            comments, next_after = Comment.objects.thread_page(
+                content_type,
+                object_id,
+                COMMENTS_THREADS_PER_PAGE,
+                after,
+                archived=COMMENTS_INCLUDE_ARCHIVED,
+                rows=COMMENTS_ROW_MODE
+            )
+            comments = comments.rows() if COMMENTS_ROW_MODE and isinstance(comments, QuerySet) else list(comments)
+            timer.set(rows=len(comments))
+
+        with metrics.timer('comments.collapse', view='CommentPage'):
+            comments = collapse_comment_tree(comments, COMMENTS_MAX_REPLIES, COMMENTS_COLLAPSE_DEPTH)
+
+        with metrics.timer('comments.render', view='CommentPage'):
+            render_comment_page = get_comment_page_renderer()
+
+            if render_comment_page is not None:
+                rendered_comment_list = render_comment_page(comments, Context({'perms': PermWrapper(request.user)}))
+            else:
+                context = RequestContext(request, {'comment_list': comments})
+                rendered_comment_list = render_to_string(RENDER_COMMENT_PAGE, context)
+
+        return HttpResponse(json.dumps({
+            'success': True,
+            'comment_list': rendered_comment_list,
+            'next_after': next_after
+        }))
+
+
+class CommentTreeJSON(MetricsMixin, View):
+    """
+    Stream comment tree of object as nested JSON.
+    Query parameters: object_id, after (root id of last thread of previous page),
+    limit (number of root threads), max_depth (limit and max_depth must be positive).
+    Archived threads are not streamed (see ArchivedComment).
+
+    """
+
+    def get(self, request, *args, **kwargs):
+        model = self.kwargs.get('model')
+        content_type = ContentType.objects.get_for_model(model)
+
+        try:
+            object_id = int(request.GET['object_id'])
+            after, limit, max_depth = [
+                int(request.GET[name]) if request.GET.get(name) else None
+                for name in ('after', 'limit', 'max_depth')
+            ]
+        except (KeyError, ValueError):
+            return json_error_response(str(ALERTS['wrong_query_parameters']), status=400)
+
+        if (limit is not None and limit < 1) or (max_depth is not None and max_depth < 1):
+            return json_error_response(str(ALERTS['wrong_query_parameters']), status=400)
+
+        self.next_after = None
+        comments = self.iter_comments(content_type, object_id, after, limit, max_depth)
+
+        def stream():
+            # response is streamed after dispatch, so streaming is timed separately...
+            with metrics.timer('comments.render', view='CommentTreeJSON'):
+                yield '{"success": true, "comments": '
+
+                for chunk in iter_comment_tree_json(comments, DjangoJSONEncoder):
+                    yield chunk
+
+                yield ', "next_after": {0}}}'.format(json.dumps(self.next_after))
+
+        return StreamingHttpResponse(stream(), content_type='application/json')
+
+    def iter_comments(self, content_type, object_id, after, limit, max_depth):
+        """
+        Yield comments of root threads page by page, so memory does not depend on number of comments.
+
+        """
+        while limit is None or limit > 0:
+            chunk_size = COMMENTS_JSON_CHUNK_SIZE if limit is None else min(limit, COMMENTS_JSON_CHUNK_SIZE)
+            comments, next_after = Comment.objects.thread_page(content_type, object_id, chunk_size, after)
+
+            if max_depth is not None:
+                comments = comments.filter(path__len__lte=max_depth)
+
+            for comment in comments.values_list(*JSON_COMMENT_FIELDS).iterator():
+                yield comment_values_to_dict(comment)
+
+            if next_after is None:
+                break
+
+            after = next_after
+            limit = None if limit is None else limit - chunk_size
+
+            if limit == 0:
+                self.next_after = next_after
+
+
+class CommentSubtree(MetricsMixin, View):
+    """
+    Return replies of comment hidden by COMMENTS_MAX_REPLIES or COMMENTS_COLLAPSE_DEEP_REPLIES,
+    replies already shown by collapse_comment_tree are skipped (replies of archived comment
+    are read from ArchivedComment table).
+    Query parameters: comment_id, format ("html" - rendered comments, "json").
+
+    """
+
+    def get(self, request, *args, **kwargs):
+        comment_id = request.GET.get('comment_id')
+
+        fields = ('id', 'path', 'content_type', 'object_id')
+
+        try:
+            try:
+                comment = Comment.objects.only(*fields).get(pk=comment_id)
+            except Comment.DoesNotExist:
+                # replies of archived thread (ids are kept by archival)...
+                comment = ArchivedComment.objects.only(*fields).get(pk=comment_id)
+        except (ObjectDoesNotExist, ValueError):
+            return json_error_response(str(ALERTS['comment_not_exist']).format(comment_id))
+
+        descendants = Comment.objects.descendants(comment)
+
+        if request.GET.get('format') == 'json':
+            # replies shown by collapse_comment_tree are skipped...
+            rows = hidden_replies([comment] + descendants.rows(), COMMENTS_MAX_REPLIES, COMMENTS_COLLAPSE_DEPTH)
+            comments = [
+                comment_values_to_dict((
+                    row.id, row.parent_id, row.path, row.user.username, row.comment, row.pub_date, row.is_removed
+                ))
+                for row in rows
+            ]
+
+            return HttpResponse(json.dumps({'success': True, 'comments': comments}, cls=DjangoJSONEncoder))
+
+        with metrics.timer('comments.query', view='CommentSubtree') as timer:
+            descendants = list(descendants.for_tree())
+            timer.set(rows=len(descendants))
+
+        descendants = hidden_replies([comment] + descendants, COMMENTS_MAX_REPLIES, COMMENTS_COLLAPSE_DEPTH)
+
+        with metrics.timer('comments.render', view='CommentSubtree'):
+            comments = [
+                {
+                    'id': descendant.id,
+                    'parent': descendant.parent_id,
+                    'comment': render_comment(request, descendant, RENDER_COMMENT)
+                }
+                for descendant in descendants
+            ]
+
+        return HttpResponse(json.dumps({'success': True, 'comment_id': comment.id, 'comments': comments}))
+
+
+class CommentSync(MetricsMixin, View):
+    """
+    Return changes of comments of object after client cursor: new comments ordered by id
+    (parents before replies) with their path and depth, and ids of removed comments.
+    Query parameters: object_id, since_id (highest comment id seen by client), since (time of
+    previous sync, removals are returned only with it), format ("html" - rendered comments, "json").
+    Response "cursor" is passed as since_id and since to the next request, if "complete"
+    is false there are more new comments than COMMENTS_SYNC_LIMIT. "since" of cursor is
+    taken from clock of database (ISO time with offset, "since" without offset is read in
+    current time zone) and goes back by COMMENTS_SYNC_OVERLAP seconds, so
+    changes may be returned twice and client skips comments and removals it already has.
+    Archived threads are not returned (archival moves only threads without new comments).
+
+    """
+
+    def get(self, request, *args, **kwargs):
+        model = self.kwargs.get('model')
+        content_type = ContentType.objects.get_for_model(model)
+
+        try:
+            object_id = int(request.GET['object_id'])
+            since_id = int(request.GET['since_id']) if request.GET.get('since_id') else None
+            since = parse_datetime(request.GET['since']) if request.GET.get('since') else None
+        except (KeyError, ValueError):
+            return json_error_response(str(ALERTS['wrong_query_parameters']))
+
+        # cursor without offset is time of current time zone, ambiguous time is read
+        # as the earlier one (changes are returned again rather than missed)...
+        if since is not None and settings.USE_TZ and timezone.is_naive(since):
+            since = timezone.make_aware(since, is_dst=True)
+        elif since is not None and not settings.USE_TZ and timezone.is_aware(since):
+            since = timezone.make_naive(since)
+
+        # cursor is taken before queries, so changes made meanwhile are returned next time too...
+        now = Comment.objects.database_time() - timedelta(seconds=COMMENTS_SYNC_OVERLAP)
+
+        # cursor is sent with offset, so it means the same time whatever time zone client has...
+        if timezone.is_naive(now):
+            now = timezone.make_aware(now, is_dst=True)
+        added, removed = Comment.objects.changes_since(content_type, object_id, since_id, since)
+
+        with metrics.timer('comments.query', view='CommentSync') as timer:
+            if request.GET.get('format') == 'html':
+                added = list(added.for_tree()[:COMMENTS_SYNC_LIMIT + 1])
+            else:
+                added = list(added.values_list(*JSON_COMMENT_FIELDS)[:COMMENTS_SYNC_LIMIT + 1])
+
+            removed = list(removed.values_list('pk', flat=True))
+            timer.set(rows=len(added) + len(removed))
+
+        complete = len(added) <= COMMENTS_SYNC_LIMIT
+        added = added[:COMMENTS_SYNC_LIMIT]
+
+        if request.GET.get('format') == 'html':
+            with metrics.timer('comments.render', view='CommentSync'):
+                comments = [
+                    {
+                        'id': comment.id,
+                        'parent': comment.parent_id,
+                        'path': comment.path,
+                        'depth': comment.depth,
+                        'comment': render_comment(request, comment, RENDER_COMMENT)
+                    }
+                    for comment in added
+                ]
+        else:
+            comments = [comment_values_to_dict(values) for values in added]
+
+        return HttpResponse(json.dumps({
+            'success': True,
+            'comments': comments,
+            'removed': removed,
+            'complete': complete,
+            'cursor': {
+                'since_id': comments[-1]['id'] if comments else since_id,
+                'since': now
+            }
+        }, cls=DjangoJSONEncoder))
+
+
+class CommentEvents(MetricsMixin, View):
+    """
+    Stream events of comments of object as Server-Sent Events: "add" (id, parent, comment),
+    "remove" (comment_id, comment), "remove_tree" (parent_id, replace_data, list_id).
+    Query parameters: object_id. Reconnected client sends Last-Event-ID header and receives
+    missed events if broker keeps them (see COMMENTS_BROKER). Stream is closed after
+    COMMENTS_EVENTS_MAX_DURATION seconds (client reconnects), disconnected client is
+    noticed when heartbeat is not sent.
+
+    """
+
+    def get(self, request, *args, **kwargs):
+        model = self.kwargs.get('model')
+        content_type = ContentType.objects.get_for_model(model)
+
+        try:
+            object_id = int(request.GET['object_id'])
+            last_event_id = request.META.get('HTTP_LAST_EVENT_ID')
+            last_event_id = int(last_event_id) if last_event_id else None
+        except (KeyError, ValueError):
+            return json_error_response(str(ALERTS['wrong_query_parameters']))
+
+        events = broker.get_broker().subscribe(
+            broker.channel_name(content_type.pk, object_id),
+            last_event_id,
+            broker.COMMENTS_EVENTS_HEARTBEAT
+        )
+
+        deadline = time.time() + broker.COMMENTS_EVENTS_MAX_DURATION
+
+        def stream():
+            try:
+                # comment line makes browser open connection before first event...
+                yield ': connected\n\n'
+
+                for event in events:
+                    if event is None:
+                        yield ': heartbeat\n\n'
+                    else:
+                        event_id, name, data = event
+                        yield 'id: {0}\nevent: {1}\ndata: {2}\n\n'.format(event_id, name, json.dumps(data))
+
+                    if time.time() >= deadline:
+                        break
+            finally:
+                # subscription (connection of PostgresBroker) is released when client is gone...
+                events.close()
+
+        response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+
+        return response
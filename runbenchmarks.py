@@ -0,0 +1,21 @@
+import sys
+
+import django
+from django.conf import settings
+
+from tests import tests_settings
+
+
+if not settings.configured:
+    settings.configure(tests_settings)
+
+
+def runbenchmarks():
+    django.setup()
+
+    from benchmarks.suite import main
+
+    main(sys.argv[1:])
+
+if __name__ == '__main__':
+    runbenchmarks()
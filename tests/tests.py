@@ -1,14 +1,47 @@
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import json
+import time
+from datetime import timedelta
+
 from django.apps import apps
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.core.exceptions import ObjectDoesNotExist
-from django.test import TestCase, Client
-from django.utils import six
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.core.management import call_command
+from django.db import connection, connections
+from django.template import Context, Template
+from django.contrib import admin
+from django.test import TestCase, Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import six, timezone
+from django.utils.dateparse import parse_datetime
 from django.contrib.contenttypes.models import ContentType
-
+from django.contrib.auth.context_processors import PermWrapper
+from django.contrib.auth.models import Permission
+from django.template.loader import render_to_string
+
+from comments import broker, cache, metrics
+from comments.admin import CommentTabularInline, EstimatedCountPaginator, PubDateDrilldownFilter
+from comments.renderers import render_comment_page
+from comments.templatetags.comment_tags import annotate_tree
+from comments.routers import (
+    COMMENTS_PIN_COOKIE,
+    CommentRouter,
+    ReplicaPinningMiddleware,
+    is_pinned,
+    reset_pinning,
+    use_primary
+)
 from comments.views import ALERTS
 from comments.forms import CommentForm
-from comments.models import Comment
+from comments.models import ArchivedComment, Comment, CommentCounter, CommentRow, COMMENTS_MAX_DEPTH
+from comments.tree import get_tree_backend, LtreeTreeBackend
+from comments.utils import annotate_comment_tree, collapse_comment_tree, CommentTree, hidden_replies
 
 from . import models
 
@@ -71,6 +104,22 @@ def _get_user_or_create():
     return test_user
 
 
+def _create_comment_tree(size, commented_object, user, children=3):
+    content_type = ContentType.objects.get_for_model(commented_object)
+
+    items = [
+        (i, (i - 1) // children if i else None, Comment(
+            user=user,
+            content_type=content_type,
+            object_id=commented_object.pk,
+            comment='comment {0}'.format(i)
+        ))
+        for i in range(size)
+    ]
+
+    return Comment.objects.bulk_create_tree(items)
+
+
 class RemoveCommentsMixin:
     def test_remove_not_exist_comment(self):
         response = self.client.post(self.url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
@@ -98,6 +147,26 @@ class BaseTest:
 
         self.assertEqual(login, True)
 
+    def create_comment(self, obj=None, parent=None, comment='test', is_removed=False):
+        obj = obj or self.commented_object
+
+        return Comment.objects.create(
+            user=self.test_user,
+            content_type=ContentType.objects.get_for_model(obj),
+            object_id=obj.id,
+            parent=parent,
+            comment=comment,
+            is_removed=is_removed
+        )
+
+    def render_comment_list(self, obj=None, user=None):
+        context = {'object': obj or self.commented_object}
+
+        if user is not None:
+            context['user'] = user
+
+        return Template('{% load comment_tags %}{% render_comment_list for object %}').render(Context(context))
+
 
 class BaseViewTest(BaseTest):
     def test_get_not_ajax_query(self):
@@ -286,7 +355,7 @@ class CommentModelAndManagerTest(BaseTest, TestCase):
 
         qs = self.comment_model.objects.remove_comment(base_comment_in_thread.id)
 
-        self.assertEqual(qs.count(), 1)
+        self.assertEqual(len(qs), 1)
 
         base_comment_in_thread.refresh_from_db()
         last_comment_in_thread.refresh_from_db()
@@ -296,7 +365,7 @@ class CommentModelAndManagerTest(BaseTest, TestCase):
 
         qs = self.comment_model.objects.remove_comment_tree(base_comment_in_thread.id)
 
-        self.assertEqual(qs.count(), 4)
+        self.assertEqual(len(qs), 4)
 
         base_comment_in_thread.refresh_from_db()
         last_comment_in_thread.refresh_from_db()
@@ -304,6 +373,20 @@ class CommentModelAndManagerTest(BaseTest, TestCase):
         self.assertTrue(base_comment_in_thread.is_removed)
         self.assertTrue(last_comment_in_thread.is_removed)
 
+    def test_remove_comment_tree_by_chunks(self):
+        with CaptureQueriesContext(connection) as queries:
+            removed = self.comment_model.objects._remove('path @> ARRAY[%s]::integer[]', [1], chunk_size=3)
+
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE "comments_comment" ')]
+
+        self.assertEqual(len(updates), 2)
+        # matching comments are selected once, chunks are updated by ids...
+        self.assertEqual(len([query for query in queries.captured_queries if 'path @>' in query['sql']]), 1)
+        self.assertEqual([comment.id for comment in removed], [1, 2, 3, 6])
+        self.assertEqual([comment.depth for comment in removed], [1, 2, 3, 3])
+        self.assertFalse(self.comment_model.objects.filter(path__contains=[1], is_removed=False).exists())
+        self.assertEqual(self.comment_model.objects.comments_count(removed[0].content_type_id, 1, False), 2)
+
     def test_remove_not_exist_comments(self):
         try:
             self.comment_model.objects.remove_comment(-1)
@@ -326,3 +409,1460 @@ class CommentModelAndManagerTest(BaseTest, TestCase):
 
         except ObjectDoesNotExist:
             pass
+
+
+class CommentPaginationTest(BaseTest, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super(CommentPaginationTest, cls).setUpTestData()
+        cls.content_type = Comment.objects.get(pk=COMMENTS_IDS_ADN_DEPTH['base']).content_type
+
+    def test_thread_page(self):
+        comments, next_after = Comment.objects.thread_page(self.content_type, 1, 1)
+
+        self.assertEqual([comment.id for comment in comments], [1, 2, 3, 6])
+        self.assertEqual(next_after, 1)
+
+        comments, next_after = Comment.objects.thread_page(self.content_type, 1, 1, next_after)
+
+        self.assertEqual([comment.id for comment in comments], [4, 5])
+        self.assertIsNone(next_after)
+
+    def test_thread_page_without_limit(self):
+        comments, next_after = Comment.objects.thread_page(self.content_type, 1, after=1)
+
+        self.assertEqual([comment.id for comment in comments], [4, 5])
+        self.assertIsNone(next_after)
+
+    def test_annotate_comment_tree_on_page_boundaries(self):
+        next_after = None
+
+        for _ in range(2):
+            comments, next_after = Comment.objects.thread_page(self.content_type, 1, 1, next_after)
+            annotated = list(annotate_comment_tree(list(comments)))
+
+            opened = len([comment for comment in annotated if getattr(comment, 'open', False)])
+            closed = sum(len(comment.close) for comment in annotated if hasattr(comment, 'close'))
+
+            self.assertEqual(opened, closed)
+
+    def test_comment_page_view(self):
+        url = reverse('comment_page')
+
+        response = self.client.get(url, {'object_id': 1, 'after': 1}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'next_after')
+        self.assertNotContains(response, 'error_message')
+
+        response = self.client.get(url, {'object_id': 1}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+        self.assertContains(response, 'error_message')
+
+
+class CommentCounterTest(BaseTest, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super(CommentCounterTest, cls).setUpTestData()
+        cls.content_type = ContentType.objects.get_for_model(cls.commented_object_model)
+
+    def get_counter(self):
+        return CommentCounter.objects.get(content_type=self.content_type, object_id=self.commented_object.id)
+
+    def test_missing_counter_is_counted_without_write(self):
+        fixture_comment = Comment.objects.get(pk=COMMENTS_IDS_ADN_DEPTH['base'])
+        CommentCounter.objects.all().delete()
+
+        self.assertEqual(Comment.objects.comments_count(fixture_comment.content_type, fixture_comment.object_id), 6)
+        self.assertFalse(CommentCounter.objects.exists())
+
+        CommentCounter.objects.rebuild_all()
+
+        with self.assertNumQueries(1):
+            Comment.objects.comments_count(fixture_comment.content_type, fixture_comment.object_id)
+
+    def test_counter_follows_save_and_remove(self):
+        root = self.create_comment()
+        child = self.create_comment(parent=root)
+        self.create_comment(parent=child)
+
+        counter = self.get_counter()
+
+        self.assertEqual(counter.total, 3)
+        self.assertEqual(counter.not_removed, 3)
+
+        Comment.objects.remove_comment(child.id)
+        counter.refresh_from_db()
+
+        self.assertEqual(counter.not_removed, 2)
+
+        Comment.objects.remove_comment_tree(root.id)
+        counter.refresh_from_db()
+
+        self.assertEqual(counter.total, 3)
+        self.assertEqual(counter.not_removed, 0)
+        self.assertEqual(Comment.objects.comments_count(self.content_type, self.commented_object.id), 3)
+
+    def test_save_changes_counter_when_is_removed_flips(self):
+        comment = self.create_comment()
+        CommentCounter.objects.filter(content_type=self.content_type).update(total=100, not_removed=100)
+
+        # counter is not rebuilt by save of existing comment...
+        comment.comment = 'edited'
+        comment.save()
+        counter = self.get_counter()
+
+        self.assertEqual((counter.total, counter.not_removed), (100, 100))
+
+        comment.is_removed = True
+        comment.save()
+        comment.save()
+        counter.refresh_from_db()
+
+        self.assertEqual((counter.total, counter.not_removed), (100, 99))
+
+        comment.is_removed = False
+        comment.save()
+        counter.refresh_from_db()
+
+        self.assertEqual((counter.total, counter.not_removed), (100, 100))
+
+    def test_rebuild_command(self):
+        self.create_comment()
+        CommentCounter.objects.filter(content_type=self.content_type).update(total=100, not_removed=100)
+
+        call_command('rebuild_comment_counters', stdout=six.StringIO())
+
+        counter = self.get_counter()
+
+        self.assertEqual(counter.total, 1)
+        self.assertEqual(counter.not_removed, 1)
+
+
+class CommentCountPrefetchTest(BaseTest, TestCase):
+    def test_prefetch_comments_count(self):
+        self.create_comment()
+        self.create_comment()
+
+        objects = [self.commented_object, self.commented_object_model.objects.create(), self.test_user]
+        content_types = ContentType.objects.get_for_models(*[type(obj) for obj in objects])
+
+        # counters of objects without comments are created by the write path, then one query
+        # is made per model...
+        for obj in objects[1:]:
+            CommentCounter.objects.change(content_types[type(obj)].pk, obj.pk)
+
+        with self.assertNumQueries(2):
+            Comment.objects.prefetch_comments_count(objects)
+
+        self.assertEqual([obj.comments_count for obj in objects], [2, 0, 0])
+
+    def test_with_comments_count_filter(self):
+        self.create_comment()
+
+        template = Template(
+            '{% load comment_tags %}'
+            '{% for obj in objects|with_comments_count %}{% comments_count obj %};{% endfor %}'
+        )
+        objects = self.commented_object_model.objects.filter(pk=self.commented_object.pk)
+
+        self.assertEqual(template.render(Context({'objects': objects})), '1;')
+
+    def test_prefetch_counts_missing_counters(self):
+        other_object = self.commented_object_model.objects.create()
+        self.create_comment()
+        self.create_comment(is_removed=True)
+        self.create_comment(other_object)
+        CommentCounter.objects.filter(
+            content_type=ContentType.objects.get_for_model(self.commented_object_model)
+        ).delete()
+
+        objects = Comment.objects.prefetch_comments_count([self.commented_object, other_object])
+
+        self.assertEqual([obj.comments_count for obj in objects], [2, 1])
+
+        objects = Comment.objects.prefetch_comments_count([self.commented_object], include_removed=False)
+
+        self.assertEqual(objects[0].comments_count, 1)
+        self.assertFalse(CommentCounter.objects.filter(
+            content_type=ContentType.objects.get_for_model(self.commented_object_model),
+            object_id=other_object.id
+        ).exists())
+
+
+class CommentPathTest(BaseTest, TestCase):
+    def test_path_is_computed_by_insert(self):
+        root = self.create_comment()
+
+        with CaptureQueriesContext(connection) as queries:
+            child = self.create_comment(parent=root)
+
+        statements = [query['sql'] for query in queries.captured_queries]
+
+        self.assertEqual(len([sql for sql in statements if sql.startswith('WITH new_comment')]), 1)
+        self.assertFalse([sql for sql in statements if sql.startswith('UPDATE "comments_comment" ')])
+        self.assertFalse([sql for sql in statements if sql.startswith('SELECT') and '"comments_comment"' in sql])
+
+        self.assertEqual(root.path, [root.id])
+        self.assertEqual(child.path, [root.id, child.id])
+
+        child.refresh_from_db()
+
+        self.assertEqual(child.path, [root.id, child.id])
+
+
+class CommentBulkCreateTreeTest(BaseTest, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super(CommentBulkCreateTreeTest, cls).setUpTestData()
+        cls.content_type = ContentType.objects.get_for_model(cls.commented_object_model)
+
+    def comment(self, text):
+        return Comment(
+            user=self.test_user,
+            content_type=self.content_type,
+            object_id=self.commented_object.id,
+            comment=text
+        )
+
+    def imported(self):
+        # fixture comments have the same content type...
+        return Comment.objects.filter(content_type=self.content_type, object_id=self.commented_object.id)
+
+    def test_bulk_create_tree(self):
+        items = [
+            ('c', 'b', self.comment('c')),
+            ('a', None, self.comment('a')),
+            ('d', 'a', self.comment('d')),
+            ('b', 'a', self.comment('b')),
+            ('e', None, self.comment('e')),
+        ]
+
+        known = Comment.objects.bulk_create_tree(items, batch_size=2)
+        ids = {key: value[0] for key, value in known.items()}
+
+        self.assertEqual(set(ids), {'a', 'b', 'c', 'd', 'e'})
+
+        comments = {comment.comment: comment for comment in Comment.objects.filter(pk__in=ids.values())}
+
+        self.assertEqual(comments['a'].path, [ids['a']])
+        self.assertEqual(comments['b'].path, [ids['a'], ids['b']])
+        self.assertEqual(comments['c'].path, [ids['a'], ids['b'], ids['c']])
+        self.assertEqual(comments['c'].parent_id, ids['b'])
+        self.assertEqual(comments['d'].root_id, ids['a'])
+        self.assertEqual(comments['e'].path, [ids['e']])
+        self.assertEqual(known['c'], (ids['c'], comments['c'].path))
+        self.assertEqual(Comment.objects.comments_count(self.content_type, self.commented_object.id), 5)
+
+    def test_bulk_create_tree_resume(self):
+        known = Comment.objects.bulk_create_tree([('a', None, self.comment('a'))])
+
+        items = [
+            ('a', None, self.comment('a')),
+            ('b', 'a', self.comment('b')),
+        ]
+
+        Comment.objects.bulk_create_tree(items, known=known)
+
+        self.assertEqual(sorted(self.imported().values_list('comment', flat=True)), ['a', 'b'])
+        self.assertEqual(Comment.objects.get(pk=known['b'][0]).parent_id, known['a'][0])
+
+    def test_bulk_create_tree_twice_given_key(self):
+        items = [
+            ('a', None, self.comment('a')),
+            ('a', None, self.comment('a')),
+        ]
+
+        self.assertRaises(ValueError, Comment.objects.bulk_create_tree, items)
+
+    def test_bulk_create_tree_without_parent(self):
+        items = [
+            ('a', 'missing', self.comment('a')),
+        ]
+
+        self.assertRaises(ValueError, Comment.objects.bulk_create_tree, items)
+        self.assertFalse(self.imported().exists())
+
+    def test_bulk_create_tree_removed_at(self):
+        removed = self.comment('removed')
+        removed.is_removed = True
+
+        known = Comment.objects.bulk_create_tree([('a', None, self.comment('a')), ('b', 'a', removed)])
+
+        self.assertIsNone(Comment.objects.get(pk=known['a'][0]).removed_at)
+        self.assertIsNotNone(Comment.objects.get(pk=known['b'][0]).removed_at)
+
+
+class CommentPrefetchTest(BaseTest, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super(CommentPrefetchTest, cls).setUpTestData()
+        cls.content_type = ContentType.objects.get_for_model(cls.commented_object_model)
+
+    def test_prefetch_top_comments(self):
+        other_object = self.commented_object_model.objects.create()
+        first = self.create_comment(self.commented_object)
+        first_reply = self.create_comment(self.commented_object, parent=first)
+        self.create_comment(self.commented_object, parent=first)
+        second = self.create_comment(self.commented_object)
+        self.create_comment(self.commented_object, is_removed=True)
+        last = self.create_comment(self.commented_object)
+        other = self.create_comment(other_object)
+
+        objects = Comment.objects.prefetch_top_comments(
+            [self.commented_object, other_object, self.test_user], limit=2, replies=1
+        )
+
+        self.assertEqual([comment.id for comment in objects[0].top_comments], [last.id, second.id])
+        self.assertEqual([comment.id for comment in objects[1].top_comments], [other.id])
+        self.assertEqual(objects[2].top_comments, [])
+
+        objects = Comment.objects.prefetch_top_comments([self.commented_object], limit=3, replies=1)
+
+        self.assertEqual(
+            [comment.id for comment in objects[0].top_comments],
+            [last.id, second.id, first.id, first_reply.id]
+        )
+        self.assertEqual(objects[0].top_comments[-1].user, self.test_user)
+
+    def test_prefetch_top_comments_queries(self):
+        objects = [self.commented_object_model.objects.create() for i in range(10)]
+
+        for obj in objects:
+            self.create_comment(obj, parent=self.create_comment(obj))
+
+        ContentType.objects.get_for_models(self.commented_object_model)
+
+        # comments and their authors...
+        with self.assertNumQueries(2):
+            Comment.objects.prefetch_top_comments(objects[:1], replies=1)
+
+        with self.assertNumQueries(2):
+            Comment.objects.prefetch_top_comments(objects, replies=1)
+
+        self.assertTrue(all(len(obj.top_comments) == 2 for obj in objects))
+
+    def test_prefetch_top_comments_tag(self):
+        self.create_comment(self.commented_object)
+
+        template = Template(
+            '{% load comment_tags %}{% prefetch_top_comments objects limit=1 as objects %}'
+            '{% for obj in objects %}{{ obj.top_comments|length }};{% endfor %}'
+        )
+        objects = self.commented_object_model.objects.filter(pk=self.commented_object.pk)
+
+        self.assertEqual(template.render(Context({'objects': objects})), '1;')
+
+
+class CommentTreeQueriesTest(BaseTest, TestCase):
+    template = Template('{% load comment_tags %}{% render_comment_list for object %}')
+
+    def assertRenderQueries(self, size):
+        commented_object = self.commented_object_model.objects.create()
+        _create_comment_tree(size, commented_object, self.test_user)
+
+        # content type is cached after the first query...
+        ContentType.objects.get_for_model(commented_object)
+
+        with self.assertNumQueries(1):
+            rendered = self.template.render(Context({'object': commented_object}))
+
+        self.assertEqual(rendered.count('class="comment_user"'), size)
+
+    def test_render_small_tree(self):
+        self.assertRenderQueries(10)
+
+    def test_render_large_tree(self):
+        self.assertRenderQueries(1000)
+
+    def test_comment_str(self):
+        comment = Comment.objects.filter(pk=COMMENTS_IDS_ADN_DEPTH['base']).for_tree().get()
+        ContentType.objects.get_for_id(comment.content_type_id)
+
+        with self.assertNumQueries(0):
+            str(comment)
+
+
+@mock.patch('comments.cache.COMMENTS_CACHE', 'default')
+class CommentTreeCacheTest(BaseTest, TestCase):
+    def setUp(self):
+        super(CommentTreeCacheTest, self).setUp()
+        caches['default'].clear()
+
+    def render(self):
+        return self.render_comment_list(user=self.test_user)
+
+    def test_cached_tree_is_rendered_without_queries(self):
+        self.create_comment(comment='cached comment')
+        rendered = self.render()
+
+        # permissions of user are cached on user instance...
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render(), rendered)
+
+    def test_cached_tree_is_invalidated(self):
+        comment = self.create_comment(comment='first comment')
+
+        self.assertIn('first comment', self.render())
+
+        self.create_comment(comment='second comment')
+
+        self.assertIn('second comment', self.render())
+
+        Comment.objects.remove_comment(comment.id)
+
+        self.assertNotIn('first comment', self.render())
+
+        Comment.objects.remove_comment_tree(comment.id)
+
+        self.assertNotIn('first comment', self.render())
+
+
+class CommentTreeLRUTest(BaseTest, TestCase):
+    def setUp(self):
+        super(CommentTreeLRUTest, self).setUp()
+        caches['default'].clear()
+        self.tree_lru = cache.LRUTreeCache(2, 60)
+
+        # versions are kept in local memory cache of tests process...
+        for patcher in (
+            mock.patch('comments.cache.tree_lru', self.tree_lru),
+            mock.patch('comments.cache.COMMENTS_VERSION_CACHE', 'default'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_tree_is_kept(self):
+        self.create_comment(comment='kept comment')
+        rendered = self.render_comment_list()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render_comment_list(), rendered)
+
+        self.assertEqual(cache.tree_cache_stats(), {'hits': 1, 'misses': 1, 'evictions': 0, 'size': 1})
+
+    def test_tree_is_invalidated(self):
+        comment = self.create_comment(comment='first comment')
+
+        self.assertIn('first comment', self.render_comment_list())
+
+        self.create_comment(comment='second comment')
+
+        self.assertIn('second comment', self.render_comment_list())
+
+        Comment.objects.remove_comment(comment.id)
+
+        self.assertNotIn('first comment', self.render_comment_list())
+        self.assertEqual(self.tree_lru.hits, 0)
+
+    def test_least_recently_used_tree_is_evicted(self):
+        objects = [self.commented_object_model.objects.create() for i in range(3)]
+
+        for obj in objects:
+            self.create_comment(obj, comment='comment')
+
+        self.render_comment_list(objects[0])
+        self.render_comment_list(objects[1])
+        self.render_comment_list(objects[0])
+        self.render_comment_list(objects[2])
+
+        self.assertEqual(cache.tree_cache_stats(), {'hits': 1, 'misses': 3, 'evictions': 1, 'size': 2})
+
+        with self.assertNumQueries(0):
+            self.render_comment_list(objects[0])
+
+        self.render_comment_list(objects[1])
+
+        self.assertEqual(self.tree_lru.misses, 4)
+
+    def test_tree_expires(self):
+        self.create_comment(comment='comment')
+        self.render_comment_list()
+
+        with mock.patch('comments.cache.time.time', return_value=time.time() + 61):
+            self.render_comment_list()
+
+        self.assertEqual(self.tree_lru.hits, 0)
+        self.assertEqual(self.tree_lru.misses, 2)
+
+    def test_rendered_trees_do_not_share_comments(self):
+        self.create_comment(comment='comment')
+        self.render_comment_list()
+
+        key = (ContentType.objects.get_for_model(self.commented_object).pk, self.commented_object.pk)
+        tree, version = cache.get_tree(*key)
+        list(annotate_tree(tree['comment_list']))
+        kept = self.tree_lru.get(key, version)['comment_list']
+
+        self.assertEqual([comment.id for comment in tree['comment_list']], [comment.id for comment in kept])
+        self.assertFalse(set(map(id, tree['comment_list'])) & set(map(id, kept)))
+        self.assertFalse(any(hasattr(comment, 'close') for comment in kept))
+
+    def test_version_cache_must_be_shared(self):
+        with mock.patch('comments.cache.COMMENTS_VERSION_CACHE', None):
+            self.assertRaises(ImproperlyConfigured, cache.check_version_cache)
+
+        self.assertRaises(ImproperlyConfigured, cache.check_version_cache)
+
+        with mock.patch('comments.cache.COMMENTS_VERSION_CACHE', 'shared'):
+            with mock.patch('comments.cache.caches', {'shared': mock.Mock()}):
+                cache.check_version_cache()
+
+    def test_disabled(self):
+        with mock.patch('comments.cache.tree_lru', None):
+            self.assertEqual(cache.get_tree(1, 1), (None, None))
+            self.assertIsNone(cache.tree_cache_stats())
+
+
+class CommentIndexesTest(BaseTest, TestCase):
+    """
+    Indexes created by "comments" migrations must be usable by the planner for
+    hot queries. Sequential scans are disabled, because tests tables are too small
+    for planner to prefer an index otherwise.
+
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super(CommentIndexesTest, cls).setUpTestData()
+        cls.content_type = Comment.objects.get(pk=COMMENTS_IDS_ADN_DEPTH['base']).content_type
+
+    def assertUsesIndex(self, queryset, index_name):
+        sql, params = queryset.query.sql_with_params()
+
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+
+        self.assertIn(index_name, plan)
+
+    def test_tree_index(self):
+        self.assertUsesIndex(
+            Comment.objects.filter(content_type=self.content_type, object_id=1).order_by('path'),
+            'comments_comment_tree'
+        )
+
+    def test_path_gin_index(self):
+        self.assertUsesIndex(
+            Comment.objects.filter(path__contains=[COMMENTS_IDS_ADN_DEPTH['base']]),
+            'comments_comment_path_gin'
+        )
+
+    def test_not_removed_index(self):
+        self.assertUsesIndex(
+            Comment.objects.filter(content_type=self.content_type, object_id=1, is_removed=False).order_by('path'),
+            'comments_comment_not_removed'
+        )
+
+    def test_subtree_index(self):
+        if isinstance(get_tree_backend(), LtreeTreeBackend):
+            index_name = 'comments_comment_tree_path'
+        else:
+            index_name = 'comments_comment_tree'
+
+        self.assertUsesIndex(Comment.objects.descendants(Comment.objects.get(pk=2)), index_name)
+
+    def test_search_index(self):
+        self.assertUsesIndex(Comment.objects.search('fox'), 'comments_comment_search')
+
+
+class CommentTreeJSONTest(BaseTest, TestCase):
+    def get_tree(self, **params):
+        params['object_id'] = 1
+        response = self.client.get(reverse('comment_tree'), params)
+
+        self.assertEqual(response.status_code, 200)
+
+        return json.loads(b''.join(response.streaming_content).decode('utf-8'))
+
+    def test_nested_tree(self):
+        data = self.get_tree()
+        comments = data['comments']
+
+        self.assertTrue(data['success'])
+        self.assertIsNone(data['next_after'])
+        self.assertEqual([comment['id'] for comment in comments], [1, 4])
+        self.assertEqual([comment['id'] for comment in comments[0]['children']], [2])
+        self.assertEqual([comment['id'] for comment in comments[0]['children'][0]['children']], [3, 6])
+        self.assertEqual(comments[1]['children'][0]['root_id'], 4)
+
+    def test_pagination_and_max_depth(self):
+        data = self.get_tree(limit=1, max_depth=1)
+
+        self.assertEqual(data['next_after'], 1)
+        self.assertEqual(len(data['comments']), 1)
+        self.assertEqual(data['comments'][0]['children'], [])
+
+        data = self.get_tree(after=data['next_after'])
+
+        self.assertIsNone(data['next_after'])
+        self.assertEqual([comment['id'] for comment in data['comments']], [4])
+
+    def test_wrong_parameters(self):
+        response = self.client.get(reverse('comment_tree'), {'object_id': 'wrong'})
+
+        self.assertContains(response, 'error_message', status_code=400)
+
+        for params in ({'limit': 0}, {'limit': -1}, {'max_depth': 0}):
+            params['object_id'] = 1
+            response = self.client.get(reverse('comment_tree'), params)
+
+            self.assertContains(response, 'error_message', status_code=400)
+
+
+class CommentTreeTest(BaseTest, TestCase):
+    def setUp(self):
+        super(CommentTreeTest, self).setUp()
+        self.tree = CommentTree.from_queryset(Comment.objects.filter(object_id=1))
+
+    def test_tree_queries(self):
+        self.assertEqual(len(self.tree), 6)
+        self.assertEqual(self.tree.roots(), [1, 4])
+        self.assertEqual(self.tree.children(1), [2])
+        self.assertEqual(self.tree.children(2), [3, 6])
+        self.assertEqual(self.tree.children(3), [])
+        self.assertEqual(self.tree.ancestors(6), [2, 1])
+        self.assertEqual(self.tree.ancestors(1), [])
+        self.assertEqual(self.tree.subtree(2), [2, 3, 6])
+        self.assertEqual(self.tree.subtree_size(1), 4)
+        self.assertEqual(self.tree.descendants_count(4), 1)
+
+    def test_annotate_as_annotate_comment_tree(self):
+        comments = list(annotate_comment_tree(list(Comment.objects.filter(object_id=1))))
+        expected = [
+            (comment.id, comment.depth, getattr(comment, 'open', False), len(getattr(comment, 'close', [])))
+            for comment in comments
+        ]
+
+        self.assertEqual(list(self.tree.annotate(COMMENTS_MAX_DEPTH)), expected)
+
+
+class CommentSubtreeTest(BaseTest, TestCase):
+    def get_comments(self):
+        return list(Comment.objects.filter(object_id=1))
+
+    def test_collapse_by_replies(self):
+        comments = collapse_comment_tree(self.get_comments(), max_replies=1)
+
+        self.assertEqual([comment.id for comment in comments], [1, 2, 3, 4, 5])
+        self.assertEqual([comment.hidden_replies for comment in comments], [0, 1, 0, 0, 0])
+
+    def test_collapse_by_depth(self):
+        comments = collapse_comment_tree(self.get_comments(), max_depth=2)
+
+        self.assertEqual([comment.id for comment in comments], [1, 2, 4, 5])
+        self.assertEqual([comment.hidden_replies for comment in comments], [0, 2, 0, 0])
+
+    def test_descendants(self):
+        comment = Comment.objects.get(pk=2)
+
+        self.assertEqual([descendant.id for descendant in Comment.objects.descendants(comment)], [3, 6])
+
+    def test_subtree_view(self):
+        url = reverse('comment_subtree')
+
+        response = self.client.get(url, {'comment_id': 2})
+        data = json.loads(response.content.decode('utf-8'))
+
+        self.assertTrue(data['success'])
+        self.assertEqual([comment['id'] for comment in data['comments']], [3, 6])
+        self.assertEqual([comment['parent'] for comment in data['comments']], [2, 2])
+
+        response = self.client.get(url, {'comment_id': 1, 'format': 'json'})
+        data = json.loads(response.content.decode('utf-8'))
+
+        self.assertEqual([comment['id'] for comment in data['comments']], [2, 3, 6])
+        self.assertEqual(data['comments'][1]['depth'], 3)
+
+        response = self.client.get(url, {'comment_id': -1})
+
+        self.assertContains(response, 'error_message')
+
+    @mock.patch('comments.views.COMMENTS_MAX_REPLIES', 1)
+    def test_subtree_view_skips_shown_replies(self):
+        # page shows 1, 2, 3 (first reply of 2), 4, 5 - only 6 is behind "more replies" of 2...
+        url = reverse('comment_subtree')
+
+        for response_format in ('html', 'json'):
+            response = self.client.get(url, {'comment_id': 2, 'format': response_format})
+            data = json.loads(response.content.decode('utf-8'))
+
+            self.assertEqual([comment['id'] for comment in data['comments']], [6])
+
+            response = self.client.get(url, {'comment_id': 1, 'format': response_format})
+            data = json.loads(response.content.decode('utf-8'))
+
+            self.assertEqual(data['comments'], [])
+
+    def test_hidden_replies(self):
+        comments = self.get_comments()
+
+        self.assertEqual([comment.id for comment in hidden_replies(comments[1:4], max_depth=2)], [3, 6])
+        self.assertEqual([comment.id for comment in hidden_replies(comments[:4], max_depth=2)], [])
+
+
+class CommentMetricsTest(BaseTest, TestCase):
+    def setUp(self):
+        super(CommentMetricsTest, self).setUp()
+        self.backend = metrics.InMemoryBackend()
+        patcher = mock.patch('comments.metrics._backend', self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_null_backend(self):
+        with mock.patch('comments.metrics._backend', metrics.NullBackend()):
+            self.assertIs(metrics.timer('comments.query'), metrics.NULL_TIMER)
+            # annotate_tree filter stays lazy without metrics...
+            self.assertNotIsInstance(annotate_tree(Comment.objects.filter(object_id=1)), list)
+
+    def test_template_tags_events(self):
+        commented_object = self.commented_object_model.objects.create()
+        _create_comment_tree(5, commented_object, self.test_user)
+
+        Template('{% load comment_tags %}{% render_comment_list for object %}{% comments_count object %}').render(
+            Context({'object': commented_object})
+        )
+
+        query, = self.backend.filter('comments.query')
+
+        self.assertEqual(query.data, {'tag': 'render_comment_list', 'rows': 5})
+        self.assertGreaterEqual(query.duration, 0)
+        self.assertEqual(
+            [event.data['tag'] for event in self.backend.filter('comments.collapse')],
+            ['render_comment_list']
+        )
+        self.assertEqual([event.data['tag'] for event in self.backend.filter('comments.annotate')], ['annotate_tree'])
+        self.assertEqual(len(self.backend.filter('comments.render')), 1)
+        self.assertEqual(len(self.backend.filter('comments.count')), 1)
+
+    def test_view_events(self):
+        self.client.post(reverse('remove_comment'), {'comment_id': 1}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+        view, = self.backend.filter('comments.view')
+
+        self.assertEqual(view.data, {'view': 'RemoveComment', 'status': 200})
+
+
+class CommentSyncTest(BaseTest, TestCase):
+    def setUp(self):
+        super(CommentSyncTest, self).setUp()
+        self.url = reverse('comment_sync')
+
+    def sync(self, **params):
+        params['object_id'] = 1
+        return json.loads(self.client.get(self.url, params).content.decode('utf-8'))
+
+    def test_removed_at(self):
+        comment, = Comment.objects.remove_comment(3)
+        removed_at = Comment.objects.get(pk=3).removed_at
+
+        self.assertIsNotNone(removed_at)
+
+        Comment.objects.remove_comment_tree(2)
+
+        self.assertEqual(Comment.objects.get(pk=3).removed_at, removed_at)
+        self.assertIsNotNone(Comment.objects.get(pk=6).removed_at)
+
+    def test_new_comments(self):
+        response = self.sync(since_id=6)
+
+        self.assertEqual(response['comments'], [])
+        self.assertEqual(response['cursor']['since_id'], 6)
+
+        self.client.post(
+            reverse('add_comment'),
+            {'comment': 'test', 'object_id': 1, 'parent': 3},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+
+        response = self.sync(**response['cursor'])
+        comment, = response['comments']
+
+        self.assertTrue(response['complete'])
+        self.assertEqual(comment['parent'], 3)
+        self.assertEqual(comment['path'], [1, 2, 3, comment['id']])
+        self.assertEqual(comment['depth'], 4)
+        self.assertEqual(response['cursor']['since_id'], comment['id'])
+
+    def test_removed_comments(self):
+        response = self.sync(since_id=6)
+
+        Comment.objects.remove_comment_tree(2)
+
+        response = self.sync(**response['cursor'])
+
+        self.assertEqual(response['comments'], [])
+        self.assertEqual(sorted(response['removed']), [2, 3, 6])
+        # cursors overlap, so removals are returned again...
+        self.assertEqual(sorted(self.sync(**response['cursor'])['removed']), [2, 3, 6])
+
+        with mock.patch('comments.views.COMMENTS_SYNC_OVERLAP', 0):
+            response = self.sync(since_id=6)
+
+        self.assertEqual(self.sync(**response['cursor'])['removed'], [])
+
+    def test_late_commit(self):
+        cursor = self.sync(since_id=6)['cursor']
+        fixture_comment = Comment.objects.get(pk=1)
+        late, later = [
+            Comment.objects.create(
+                user=self.test_user,
+                content_type=fixture_comment.content_type,
+                object_id=fixture_comment.object_id,
+                comment='test'
+            )
+            for i in range(2)
+        ]
+
+        # comment with lower id is committed after comment with higher id was synced...
+
+        response = self.sync(since_id=later.id, since=cursor['since'])
+
+        self.assertEqual([comment['id'] for comment in response['comments']], [late.id, later.id])
+        self.assertEqual(response['cursor']['since_id'], later.id)
+
+    def test_cursor_from_database(self):
+        cursor = self.sync(since_id=6)['cursor']
+        since = parse_datetime(cursor['since'])
+        now = Comment.objects.database_time()
+
+        if timezone.is_naive(now):
+            now = timezone.make_aware(now)
+
+        self.assertIsNotNone(since.utcoffset())
+        self.assertLess(since, now - timedelta(seconds=59))
+
+    def test_naive_cursor_is_read_in_current_time_zone(self):
+        Comment.objects.remove_comment_tree(2)
+
+        with mock.patch('comments.views.COMMENTS_SYNC_OVERLAP', 0):
+            cursor = self.sync(since_id=6)['cursor']
+
+        since = timezone.make_naive(parse_datetime(cursor['since']))
+
+        self.assertEqual(self.sync(since_id=6, since=since.isoformat())['removed'], [])
+        self.assertEqual(self.sync(since_id=6, since=cursor['since'])['removed'], [])
+
+    def test_limit(self):
+        with mock.patch('comments.views.COMMENTS_SYNC_LIMIT', 4):
+            response = self.sync(since_id=0)
+
+            self.assertFalse(response['complete'])
+            self.assertEqual([comment['id'] for comment in response['comments']], [1, 2, 3, 4])
+
+            response = self.sync(**response['cursor'])
+
+            self.assertTrue(response['complete'])
+            self.assertEqual([comment['id'] for comment in response['comments']], [5, 6])
+
+    def test_html_format(self):
+        response = self.sync(since_id=4, format='html')
+
+        self.assertEqual([comment['id'] for comment in response['comments']], [5, 6])
+        self.assertIn('comment_li', response['comments'][0]['comment'])
+
+    def test_wrong_parameters(self):
+        response = self.client.get(self.url, {'object_id': 1, 'since_id': 'a'})
+
+        self.assertContains(response, 'error_message')
+
+
+class CommentSearchTest(BaseTest, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super(CommentSearchTest, cls).setUpTestData()
+        content_type = ContentType.objects.get_for_model(cls.commented_object)
+
+        for text in ('red fox', 'red fox jumps over red fence', 'lazy dog'):
+            Comment.objects.create(
+                user=cls.test_user,
+                content_type=content_type,
+                object_id=cls.commented_object.pk,
+                comment=text
+            )
+
+    def test_search(self):
+        comments = list(Comment.objects.search('red fox'))
+
+        self.assertEqual(
+            [comment.comment for comment in comments],
+            ['red fox jumps over red fence', 'red fox']
+        )
+        self.assertGreater(comments[0].search_rank, comments[1].search_rank)
+
+    def test_search_by_object(self):
+        content_type = ContentType.objects.get_for_model(self.commented_object)
+
+        self.assertEqual(Comment.objects.search('dog', content_type, self.commented_object.pk).count(), 1)
+        self.assertEqual(Comment.objects.search('dog', content_type, 1).count(), 0)
+
+    def test_search_vector_is_updated(self):
+        comment = Comment.objects.search('dog').get()
+        comment.comment = 'sleepy cat'
+        comment.save()
+
+        self.assertFalse(Comment.objects.search('dog').exists())
+        self.assertEqual(Comment.objects.search('cat').get().pk, comment.pk)
+
+
+class CommentAdminTest(BaseTest, TestCase):
+    def test_exact_count_of_small_changelist(self):
+        paginator = EstimatedCountPaginator(Comment.objects.filter(object_id=1), 2)
+
+        self.assertEqual(paginator.count, 6)
+        self.assertEqual(paginator.num_pages, 3)
+
+    def test_estimated_count(self):
+        with mock.patch('comments.admin.COMMENTS_ADMIN_ESTIMATE_COUNT_THRESHOLD', 0):
+            with CaptureQueriesContext(connection) as queries:
+                count = EstimatedCountPaginator(Comment.objects.all(), 2).count
+
+        self.assertGreaterEqual(count, 0)
+        self.assertNotIn('COUNT(', ' '.join(query['sql'] for query in queries))
+
+    def get_drilldown(self, value=None):
+        params = {'pub_date_drilldown': value} if value else {}
+        request = RequestFactory().get('/', params)
+        request.user = self.test_user
+
+        return PubDateDrilldownFilter(request, params, Comment, admin.site._registry[Comment]), request
+
+    def test_date_drilldown(self):
+        drilldown, request = self.get_drilldown()
+
+        self.assertIn('2015', [value for value, label in drilldown.lookup_choices])
+
+        drilldown, request = self.get_drilldown('2015')
+
+        self.assertEqual(drilldown.lookup_choices[0][0], '2015')
+        self.assertEqual(len(drilldown.lookup_choices), 13)
+
+        drilldown, request = self.get_drilldown('2015-10')
+
+        self.assertEqual([value for value, label in drilldown.lookup_choices][:3], ['2015', '2015-10', '2015-10-1'])
+        self.assertEqual(len(drilldown.lookup_choices), 2 + 31)
+
+        for value, count in (('2015', 6), ('2015-10', 6), ('2015-10-20', 6), ('2015-10-21', 0), ('2014', 0)):
+            drilldown, request = self.get_drilldown(value)
+            queryset = drilldown.queryset(request, Comment.objects.filter(object_id=1))
+
+            self.assertEqual(queryset.count(), count)
+            self.assertIn('"pub_date" >=', str(queryset.query))
+
+    def test_wrong_date_drilldown(self):
+        drilldown, request = self.get_drilldown('2015-13')
+        queryset = Comment.objects.filter(object_id=1)
+
+        self.assertEqual(drilldown.queryset(request, queryset).count(), 6)
+
+    def test_limited_inline(self):
+        request = RequestFactory().get('/')
+        request.user = self.test_user
+        parent = Comment.objects.get(pk=2)
+        formset_class = CommentTabularInline(Comment, admin.site).get_formset(request, parent)
+
+        with mock.patch('comments.admin.COMMENTS_ADMIN_INLINE_LIMIT', 1):
+            formset = formset_class(instance=parent, queryset=Comment.objects.all())
+
+            self.assertEqual(len(formset.forms), 1)
+            self.assertEqual(formset.forms[0].instance.pk, 3)
+
+
+class CommentArchiveTest(BaseTest, TestCase):
+    def setUp(self):
+        super(CommentArchiveTest, self).setUp()
+        self.content_type = ContentType.objects.get_for_model(self.commented_object_model)
+        self.before = timezone.now() - timedelta(days=7)
+        # thread 1 is cold, thread 4 is recent (fixture comments are published in 2015)...
+        Comment.objects.filter(path__contains=[1]).update(pub_date=timezone.now() - timedelta(days=30))
+        Comment.objects.filter(path__contains=[4]).update(pub_date=timezone.now())
+
+    def test_archive_old_threads(self):
+        paths = dict(Comment.objects.values_list('id', 'path'))
+
+        self.assertEqual(Comment.objects.archive_threads(before=self.before, batch_size=1), 4)
+        self.assertEqual(list(Comment.objects.values_list('id', flat=True)), [4, 5])
+        self.assertEqual(
+            list(ArchivedComment.objects.values_list('id', 'path')),
+            [(pk, paths[pk]) for pk in (1, 2, 3, 6)]
+        )
+
+    def test_thread_with_recent_reply_is_kept(self):
+        Comment.objects.filter(pk=6).update(pub_date=timezone.now())
+
+        self.assertEqual(Comment.objects.archive_threads(before=self.before), 0)
+        self.assertFalse(ArchivedComment.objects.exists())
+
+    def test_archive_threads_of_objects(self):
+        self.assertEqual(Comment.objects.archive_threads(content_type=self.content_type, object_ids=[2]), 0)
+        self.assertEqual(Comment.objects.archive_threads(content_type=self.content_type, object_ids=[1]), 6)
+
+    def test_counters_include_archive(self):
+        total = Comment.objects.comments_count(self.content_type, 1)
+        Comment.objects.archive_threads(before=self.before)
+
+        self.assertEqual(Comment.objects.comments_count(self.content_type, 1), total)
+
+        CommentCounter.objects.rebuild_all()
+
+        self.assertEqual(Comment.objects.comments_count(self.content_type, 1), total)
+
+        Comment.objects.archive_threads(content_type=self.content_type, object_ids=[1])
+        CommentCounter.objects.rebuild_all()
+
+        self.assertEqual(Comment.objects.comments_count(self.content_type, 1), total)
+
+    def test_include_archived(self):
+        Comment.objects.archive_threads(before=self.before)
+        template = Template('{% load comment_tags %}{% get_comment_list for object as comments %}')
+        context = Context({'object': self.commented_object_model(pk=1)})
+
+        template.render(context)
+
+        self.assertEqual([comment.id for comment in context['comments']], [4, 5])
+
+        with mock.patch('comments.templatetags.comment_tags.COMMENTS_INCLUDE_ARCHIVED', True):
+            template.render(context)
+
+        self.assertEqual([comment.id for comment in context['comments']], [1, 2, 3, 6, 4, 5])
+
+    def test_thread_page_with_archived(self):
+        Comment.objects.archive_threads(before=self.before)
+        comments, next_after = Comment.objects.thread_page(self.content_type, 1, 1)
+
+        self.assertEqual([comment.id for comment in comments], [4, 5])
+        self.assertIsNone(next_after)
+
+        comments, next_after = Comment.objects.thread_page(self.content_type, 1, 1, archived=True)
+
+        self.assertEqual([comment.id for comment in comments], [1, 2, 3, 6])
+        self.assertEqual(next_after, 1)
+
+        comments, next_after = Comment.objects.thread_page(self.content_type, 1, 1, next_after, True, rows=True)
+
+        self.assertEqual([comment.id for comment in comments], [4, 5])
+        self.assertTrue(all(isinstance(comment, CommentRow) for comment in comments))
+        self.assertIsNone(next_after)
+
+    def test_comment_page_with_archived(self):
+        Comment.objects.archive_threads(before=self.before)
+        url = reverse('comment_page')
+
+        with mock.patch('comments.views.COMMENTS_THREADS_PER_PAGE', 1):
+            with mock.patch('comments.views.COMMENTS_INCLUDE_ARCHIVED', True):
+                response = self.client.get(url, {'object_id': 1, 'after': 0}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+            data = json.loads(response.content.decode('utf-8'))
+
+            self.assertIn('id="6"', data['comment_list'])
+            self.assertEqual(data['next_after'], 1)
+
+            response = self.client.get(url, {'object_id': 1, 'after': 0}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            data = json.loads(response.content.decode('utf-8'))
+
+            self.assertNotIn('id="6"', data['comment_list'])
+            self.assertIsNone(data['next_after'])
+
+    def test_subtree_of_archived_comment(self):
+        Comment.objects.archive_threads(before=self.before)
+        response = self.client.get(reverse('comment_subtree'), {'comment_id': 2, 'format': 'json'})
+        data = json.loads(response.content.decode('utf-8'))
+
+        self.assertEqual([comment['id'] for comment in data['comments']], [3, 6])
+
+    def test_archived_threads_are_not_streamed_synced_or_removed(self):
+        Comment.objects.archive_threads(before=self.before)
+        response = self.client.get(reverse('comment_tree'), {'object_id': 1})
+        data = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+
+        self.assertEqual([comment['id'] for comment in data['comments']], [4])
+
+        response = self.client.get(reverse('comment_sync'), {'object_id': 1, 'since_id': 0})
+        data = json.loads(response.content.decode('utf-8'))
+
+        self.assertEqual([comment['id'] for comment in data['comments']], [4, 5])
+
+        with self.assertRaises(ObjectDoesNotExist):
+            Comment.objects.remove_comment_tree(1)
+
+        self.assertFalse(ArchivedComment.objects.filter(is_removed=True).exists())
+
+    def test_command(self):
+        stdout = six.StringIO()
+        call_command('archive_comments', days=7, batch_size=1, stdout=stdout)
+
+        self.assertIn('Archived 4 comments.', stdout.getvalue())
+        self.assertEqual(ArchivedComment.objects.count(), 4)
+
+
+class CommentTreeBackendTest(BaseTest, TestCase):
+    def create_reply(self, parent):
+        return Comment.objects.create(
+            user=self.test_user,
+            content_type=parent.content_type,
+            object_id=parent.object_id,
+            parent=parent,
+            comment='reply'
+        )
+
+    def test_descendants(self):
+        parent = Comment.objects.get(pk=2)
+        sibling = self.create_reply(Comment.objects.get(pk=1))
+        self.create_reply(sibling)
+        reply = self.create_reply(Comment.objects.get(pk=6))
+
+        self.assertEqual(
+            list(Comment.objects.descendants(parent).values_list('id', flat=True)),
+            [3, 6, reply.pk]
+        )
+
+    def test_remove_subtree(self):
+        sibling = self.create_reply(Comment.objects.get(pk=1))
+
+        removed = Comment.objects.remove_comment_tree(2)
+
+        self.assertEqual([comment.id for comment in removed], [2, 3, 6])
+        self.assertFalse(Comment.objects.get(pk=sibling.pk).is_removed)
+
+    def test_ltree_labels(self):
+        backend = LtreeTreeBackend()
+
+        self.assertEqual(backend.encode([1, 23]), '0000000001.0000000023')
+        self.assertLess(backend.encode([1, 9]), backend.encode([1, 10]))
+
+    def test_ltree_install(self):
+        backend = LtreeTreeBackend()
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1 FROM pg_available_extensions WHERE name = %s', ['ltree'])
+
+            if cursor.fetchone() is None:
+                self.skipTest('ltree extension is not available.')
+
+        # schema changes are rolled back together with transaction of test...
+        backend.uninstall(connection)
+
+        self.assertFalse(backend.is_installed(connection))
+
+        reply = self.create_reply(Comment.objects.get(pk=6))
+
+        self.assertEqual(backend.install(connection, batch_size=2, concurrently=False), Comment.objects.count())
+        self.assertTrue(backend.is_installed(connection))
+
+        # replies added after install are filled by trigger...
+        later_reply = self.create_reply(reply)
+        subtree = backend.subtree(Comment.objects.all(), Comment.objects.get(pk=2))
+
+        self.assertEqual(
+            list(subtree.order_by('path').values_list('id', flat=True)),
+            [2, 3, 6, reply.pk, later_reply.pk]
+        )
+
+    def test_max_length_is_importable_from_models(self):
+        from comments import models as comment_models, tree
+
+        self.assertEqual(comment_models.MAX_LENGTH_OF_COMMENT_TREE, tree.MAX_LENGTH_OF_COMMENT_TREE)
+
+
+class CommentRouterTest(BaseTest, TestCase):
+    def setUp(self):
+        super(CommentRouterTest, self).setUp()
+        self.router = CommentRouter()
+
+        patcher = mock.patch('comments.routers.COMMENTS_REPLICAS', ['replica'])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def db_for_read(self, model, in_atomic_block=False):
+        # TestCase runs every test in transaction...
+        with mock.patch.object(connection, 'in_atomic_block', in_atomic_block):
+            return self.router.db_for_read(model)
+
+    def test_routing(self):
+        self.assertEqual(self.db_for_read(Comment), 'replica')
+        self.assertEqual(self.db_for_read(CommentCounter), 'default')
+        self.assertIsNone(self.db_for_read(ContentType))
+        self.assertEqual(self.router.db_for_write(Comment), 'default')
+        self.assertIsNone(self.router.db_for_write(ContentType))
+
+    def test_reads_in_transaction(self):
+        self.assertEqual(self.db_for_read(Comment, in_atomic_block=True), 'default')
+
+    def test_reads_are_pinned_after_write(self):
+        response = self.client.post(
+            reverse('add_comment'),
+            {'comment': 'test', 'object_id': 1},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+
+        self.assertIn(COMMENTS_PIN_COOKIE, response.cookies)
+
+        # thread is unpinned when request is finished...
+        self.assertFalse(is_pinned())
+
+        request = RequestFactory().get('/')
+        request.COOKIES[COMMENTS_PIN_COOKIE] = response.cookies[COMMENTS_PIN_COOKIE].value
+        ReplicaPinningMiddleware().process_request(request)
+
+        self.assertTrue(is_pinned())
+        self.assertEqual(self.db_for_read(Comment), 'default')
+
+        # the same handler is connected to request_finished...
+        reset_pinning()
+
+        self.assertFalse(is_pinned())
+        self.assertEqual(self.db_for_read(Comment), 'replica')
+
+    def test_use_primary(self):
+        with use_primary():
+            self.assertEqual(self.db_for_read(Comment), 'default')
+
+            with use_primary():
+                pass
+
+            self.assertEqual(self.db_for_read(Comment), 'default')
+
+        self.assertEqual(self.db_for_read(Comment), 'replica')
+
+    def test_counters_are_built_on_primary(self):
+        content_type = ContentType.objects.get_for_model(self.commented_object_model)
+        CommentCounter.objects.all().delete()
+
+        with CaptureQueriesContext(connections['replica']) as queries:
+            with mock.patch.object(
+                CommentRouter,
+                'db_for_read',
+                lambda router, model, **hints: 'replica' if model in (Comment, ArchivedComment) else None
+            ):
+                self.assertEqual(CommentCounter.objects.get_counter(content_type.pk, 1).total, 6)
+                self.assertEqual(CommentCounter.objects.get_counters(content_type.pk, [2])[2].total, 0)
+                self.assertGreater(CommentCounter.objects.rebuild_all(), 0)
+
+        self.assertEqual(len(queries), 0)
+
+    def test_cached_tree_is_read_from_primary(self):
+        caches['default'].clear()
+        databases = []
+
+        def get_tree(node, context, ctype, object_id):
+            databases.append(self.db_for_read(Comment))
+            return {'comment_list': [], 'comments_count': 0}
+
+        with mock.patch('comments.templatetags.comment_tags.RenderCommentListNode.get_tree', get_tree):
+            self.render_comment_list()
+
+            with mock.patch('comments.cache.COMMENTS_CACHE', 'default'):
+                self.render_comment_list()
+
+        self.assertEqual(databases, ['replica', 'default'])
+
+
+class CommentRendererTest(BaseTest, TestCase):
+    """
+    Output of render_comment_page must be byte for byte the same as output of
+    "comments/render_comment_page.html" template.
+
+    """
+
+    def setUp(self):
+        super(CommentRendererTest, self).setUp()
+        Comment.objects.remove_comment(3)
+        Comment.objects.filter(pk=1).update(comment='<b>escaped</b> & "quoted"')
+
+    def get_comments(self, max_replies=None):
+        comments = list(Comment.objects.filter(object_id=1).for_tree())
+        return collapse_comment_tree(comments, max_replies)
+
+    def assertSameOutput(self, user, max_replies=None):
+        perms = PermWrapper(user)
+        expected = render_to_string(
+            'comments/render_comment_page.html',
+            {'comment_list': self.get_comments(max_replies), 'perms': perms}
+        )
+
+        self.assertEqual(render_comment_page(self.get_comments(max_replies), Context({'perms': perms})), expected)
+
+    def test_without_permissions(self):
+        self.assertSameOutput(self.test_user)
+
+    def test_with_permissions(self):
+        self.test_user.user_permissions.add(*Permission.objects.filter(
+            content_type__app_label='comments',
+            codename__in=['remove_comment', 'remove_comment_tree']
+        ))
+        user = _get_user_model(AUTH_USER_MODEL).objects.get(pk=self.test_user.pk)
+
+        self.assertSameOutput(user)
+
+    def test_hidden_replies(self):
+        self.assertIn('load_replies', render_comment_page(self.get_comments(max_replies=1), Context()))
+        self.assertSameOutput(self.test_user, max_replies=1)
+
+    def test_empty(self):
+        self.assertEqual(
+            render_comment_page([], Context()),
+            render_to_string('comments/render_comment_page.html', {'comment_list': []})
+        )
+
+    def test_template_tag(self):
+        template = Template('{% load comment_tags %}{% render_comment_list for object %}')
+        context = {'object': self.commented_object_model(pk=1), 'user': self.test_user}
+        expected = template.render(Context(context))
+
+        with mock.patch('comments.renderers.RENDER_COMMENT_PAGE_FUNCTION', 'comments.renderers.render_comment_page'):
+            self.assertEqual(template.render(Context(context)), expected)
+
+
+class CommentRowTest(BaseTest, TestCase):
+    def setUp(self):
+        super(CommentRowTest, self).setUp()
+        Comment.objects.remove_comment(3)
+
+    def test_rows(self):
+        queryset = Comment.objects.filter(object_id=1).for_tree()
+        comments = list(queryset)
+
+        with self.assertNumQueries(1):
+            rows = queryset.rows()
+
+        self.assertTrue(all(isinstance(row, CommentRow) for row in rows))
+        self.assertEqual(
+            [(row.id, row.parent_id, row.path, row.depth, row.root_id, row.is_removed) for row in rows],
+            [(c.id, c.parent_id, c.path, c.depth, c.root_id, c.is_removed) for c in comments]
+        )
+        self.assertEqual(rows[0].user.username, comments[0].user.username)
+        self.assertRaises(AttributeError, setattr, rows[0], 'title', 'test')
+
+    def test_same_output(self):
+        queryset = Comment.objects.filter(object_id=1).for_tree()
+
+        def render(comments):
+            return render_to_string(
+                'comments/render_comment_page.html',
+                {'comment_list': collapse_comment_tree(comments, max_replies=1)}
+            )
+
+        self.assertEqual(render(queryset.rows()), render(list(queryset)))
+        self.assertEqual(
+            render_comment_page(collapse_comment_tree(queryset.rows(), max_replies=1), Context()),
+            render(list(queryset))
+        )
+
+    def test_template_tag(self):
+        template = Template('{% load comment_tags %}{% render_comment_list for object %}')
+        context = {'object': self.commented_object_model(pk=1), 'user': self.test_user}
+        expected = template.render(Context(context))
+
+        with mock.patch('comments.templatetags.comment_tags.COMMENTS_ROW_MODE', True):
+            self.assertEqual(template.render(Context(context)), expected)
+
+            with mock.patch('comments.templatetags.comment_tags.COMMENTS_INCLUDE_ARCHIVED', True):
+                self.assertEqual(template.render(Context(context)), expected)
+
+
+class CommentEventsTest(BaseTest, TestCase):
+    def setUp(self):
+        super(CommentEventsTest, self).setUp()
+        self.broker = broker.InProcessBroker()
+        self.channel = broker.channel_name(ContentType.objects.get_for_model(self.commented_object_model).pk, 1)
+
+        for patcher in (
+            mock.patch('comments.broker._broker', self.broker),
+            # TestCase never commits, so events are published at once...
+            mock.patch('comments.broker.transaction.on_commit', lambda func, using=None: func())
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_in_process_broker(self):
+        self.broker.publish(self.channel, 'add', {'id': 1})
+        events = self.broker.subscribe(self.channel, timeout=0)
+
+        self.assertIsNone(next(events))
+
+        self.broker.publish(self.channel, 'remove', {'comment_id': 1})
+        self.broker.publish('comments_0_0', 'remove', {'comment_id': 2})
+
+        self.assertEqual(next(events), (2, 'remove', {'comment_id': 1}))
+        self.assertIsNone(next(events))
+
+        # reconnected subscriber receives missed events...
+        self.assertEqual(next(self.broker.subscribe(self.channel, last_event_id=0, timeout=0)), (1, 'add', {'id': 1}))
+
+    def test_views_publish_events(self):
+        self.client.post(
+            reverse('add_comment'),
+            {'comment': 'test', 'object_id': 1, 'parent': 4},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
+        self.client.post(reverse('remove_comment'), {'comment_id': 3}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.client.post(reverse('remove_comment_tree'), {'parent_id': 2}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+        add, remove, remove_tree = self.broker.channels[self.channel].events
+
+        self.assertEqual(add[1], 'add')
+        self.assertEqual(add[2]['parent'], 4)
+        self.assertIn('test', add[2]['comment'])
+        self.assertEqual(remove[1:], ('remove', {'comment_id': 3, 'comment': mock.ANY}))
+        self.assertEqual(remove_tree[1], 'remove_tree')
+        self.assertEqual(remove_tree[2]['parent_id'], 2)
+        self.assertEqual(remove_tree[2]['list_id'], [2, 3, 6])
+
+    def test_not_published_on_error(self):
+        self.client.post(reverse('remove_comment'), {'comment_id': 100}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+        self.assertNotIn(self.channel, self.broker.channels)
+
+    def test_event_stream(self):
+        self.broker.publish(self.channel, 'remove', {'comment_id': 3})
+
+        response = self.client.get(reverse('comment_events'), {'object_id': 1}, HTTP_LAST_EVENT_ID='0')
+        content = iter(response.streaming_content)
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(next(content), b': connected\n\n')
+        self.assertEqual(next(content), b'id: 1\nevent: remove\ndata: {"comment_id": 3}\n\n')
+
+    def test_idle_channels_are_dropped(self):
+        self.broker.channel_ttl = 0
+        self.broker.publish(self.channel, 'add', {'id': 1})
+        events = self.broker.subscribe('comments_0_0', timeout=0)
+        next(events)
+        self.broker.publish('comments_0_1', 'add', {'id': 2})
+
+        # channel with subscriber is kept...
+        self.assertEqual(set(self.broker.channels), {'comments_0_0', 'comments_0_1'})
+
+        events.close()
+        self.broker.publish('comments_0_1', 'add', {'id': 3})
+
+        self.assertEqual(set(self.broker.channels), {'comments_0_1'})
+
+    def test_event_ids(self):
+        for i in range(3):
+            self.broker.publish(self.channel, 'add', {'id': i})
+
+        event_ids = [event[0] for event in self.broker.channels[self.channel].events]
+
+        self.assertEqual(event_ids, sorted(set(event_ids)))
+
+        # unknown id (of restarted process) does not hide new events...
+        events = self.broker.subscribe(self.channel, last_event_id=1000, timeout=0)
+        self.assertIsNone(next(events))
+        self.broker.publish(self.channel, 'add', {'id': 3})
+        self.assertEqual(next(events)[2], {'id': 3})
+
+    def test_event_stream_max_duration(self):
+        with mock.patch('comments.broker.COMMENTS_EVENTS_MAX_DURATION', 0):
+            with mock.patch('comments.broker.COMMENTS_EVENTS_HEARTBEAT', 0):
+                response = self.client.get(reverse('comment_events'), {'object_id': 1})
+
+                self.assertEqual(list(response.streaming_content), [b': connected\n\n', b': heartbeat\n\n'])
+
+        self.assertEqual(self.broker.channels[self.channel].subscribers, 0)
+
+    def test_event_stream_wrong_parameters(self):
+        response = self.client.get(reverse('comment_events'), {'object_id': 'a'})
+
+        self.assertContains(response, 'error_message')
@@ -16,12 +16,27 @@ DATABASES = {
         'PORT': '5432',
         'USER': 'app_comments',
         'PASSWORD': 'app_comments',
-    }
+    },
+    # replica is the same database in tests...
+    'replica': {
+        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'NAME': 'app_comments',
+        'HOST': '127.0.0.1',
+        'PORT': '5432',
+        'USER': 'app_comments',
+        'PASSWORD': 'app_comments',
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    },
 }
 
+DATABASE_ROUTERS = ['comments.routers.CommentRouter']
+
 ROOT_URLCONF = 'tests.urls'
 
 INSTALLED_APPS = [
+    'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.sessions',
     'django.contrib.staticfiles',
@@ -35,6 +50,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'comments.routers.ReplicaPinningMiddleware',
 )
 
 TEMPLATES = [
@@ -53,6 +69,10 @@ TEMPLATES = [
     },
 ]
 
+# tree backend, the same tests are run for every backend
+
+COMMENTS_TREE_BACKEND = os.environ.get('COMMENTS_TREE_BACKEND', 'comments.tree.ArrayTreeBackend')
+
 # test conf
 
 COMMENTS_TEST_DATA = ['data.json', 'user_data.json']
@@ -9,4 +9,9 @@ urlpatterns = [
     url(r'^addcomment/$', comment_views.AddComment.as_view(), {'model': TestCommentedObject}, name='add_comment'),
     url(r'^removecomment/$', comment_views.RemoveComment.as_view(), name='remove_comment'),
     url(r'^removecomment_tree/$', comment_views.RemoveCommentTree.as_view(), name='remove_comment_tree'),
+    url(r'^commenttree/$', comment_views.CommentTreeJSON.as_view(), {'model': TestCommentedObject}, name='comment_tree'),
+    url(r'^commentsubtree/$', comment_views.CommentSubtree.as_view(), name='comment_subtree'),
+    url(r'^commentpage/$', comment_views.CommentPage.as_view(), {'model': TestCommentedObject}, name='comment_page'),
+    url(r'^commentsync/$', comment_views.CommentSync.as_view(), {'model': TestCommentedObject}, name='comment_sync'),
+    url(r'^commentevents/$', comment_views.CommentEvents.as_view(), {'model': TestCommentedObject}, name='comment_events'),
 ]